@@ -0,0 +1,75 @@
+import threading
+
+from typing import AsyncIterator, List, Tuple
+
+KB = 1024
+
+BUFFER_SIZE = 256 * KB
+"""Size of the chunks written to disk, each one fills a buffer."""
+
+MAX_POOLED = 128
+"""Number of free buffers to keep, enough for the pending writes and a chunk per worker."""
+
+
+class BufferPool:
+    """
+    Reusable buffers for chunks on their way to disk. A buffer is taken by
+    the download task, filled from the network and handed to the file
+    writer, which puts it back once written. This keeps the memory of
+    chunks in use instead of allocating a new one for every chunk.
+    """
+
+    def __init__(self, size: int = BUFFER_SIZE, max_pooled: int = MAX_POOLED):
+        self.size: int = size
+        self.max_pooled: int = max_pooled
+        self.allocated: int = 0
+        self.reused: int = 0
+        self._free: List[bytearray] = []
+        # Buffers are put back from the writer thread
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        with self._lock:
+            if self._free:
+                self.reused += 1
+                return self._free.pop()
+            self.allocated += 1
+        return bytearray(self.size)
+
+    def release(self, buffer: bytearray):
+        with self._lock:
+            if len(self._free) < self.max_pooled:
+                self._free.append(buffer)
+
+    def __str__(self):
+        return f"{self.allocated} buffers allocated, reused {self.reused} times"
+
+
+async def fill_buffers(pieces: AsyncIterator[bytes], pool: BufferPool) -> AsyncIterator[Tuple[bytearray, int]]:
+    """
+    Copy `pieces` as they arrive from the network into buffers of `pool`,
+    yields each buffer and the number of bytes in it when it's full and at
+    the end. The buffer belongs to the caller, who has to release it.
+    """
+    buffer = pool.acquire()
+    length = 0
+    try:
+        async for piece in pieces:
+            view = memoryview(piece)
+            while view:
+                n = min(len(view), pool.size - length)
+                buffer[length:length + n] = view[:n]
+                length += n
+                view = view[n:]
+                if length == pool.size:
+                    full, buffer = buffer, None
+                    yield full, length
+                    buffer = pool.acquire()
+                    length = 0
+
+        if length:
+            full, buffer = buffer, None
+            yield full, length
+    finally:
+        if buffer is not None:
+            pool.release(buffer)
@@ -0,0 +1,182 @@
+import hashlib
+import httpx
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = "cache.sqlite"
+"""Where the metadata cache is stored, next to settings.ini."""
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+TTL = {
+    "user": 7 * DAY,
+    "clip": DAY,
+    "videos": 5 * MINUTE,
+    "playlists": 10 * MINUTE,
+}
+"""How long entries of each kind are used without asking the server again, in seconds."""
+
+PRUNE_AFTER = 7 * DAY
+"""Expired entries are kept this long for revalidation, then removed."""
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    revalidated: int = 0
+    """Expired entries the server confirmed are unchanged."""
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def __str__(self):
+        return f"{self.hits} hits, {self.misses} misses ({self.revalidated} revalidated)"
+
+
+class Entry(NamedTuple):
+    value: Any
+    etag: Optional[str]
+    fresh: bool
+
+
+def cache_key(*parts: Any) -> str:
+    """A short key for the identity of a query, like its text and parameters."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def max_age(response: httpx.Response) -> Optional[int]:
+    """Lifetime allowed by the Cache-Control header, 0 if the response must not be cached."""
+    cache_control = response.headers.get("cache-control", "").lower()
+    if "no-store" in cache_control or "no-cache" in cache_control or "private" in cache_control:
+        return 0
+    match = re.search(r"max-age=(\d+)", cache_control)
+    return int(match.group(1)) if match else None
+
+
+class MetadataCache:
+    """
+    Twitch metadata stored in SQLite, so browsing the same channel again
+    doesn't repeat all requests. Entries are stored as JSON per kind and
+    key and used until their TTL runs out. Expired entries with an ETag are
+    revalidated with a conditional request instead of fetched again.
+    """
+
+    def __init__(self, path: str = CACHE_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "kind TEXT, key TEXT, value TEXT, etag TEXT, expires REAL, PRIMARY KEY (kind, key))"
+        )
+        self._db.execute("DELETE FROM entries WHERE expires < ?", (time.time() - PRUNE_AFTER,))
+        self.stats = stats
+
+    def lookup(self, kind: str, key: str) -> Optional[Entry]:
+        """Return the entry whether it's expired or not, without counting a hit or miss."""
+        with self._lock:
+            row = self._db.execute("SELECT value, etag, expires FROM entries WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        if row is None:
+            return None
+        value, etag, expires = row
+        return Entry(json.loads(value), etag, expires > time.time())
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        """Return the value if it's fresh, otherwise None."""
+        entry = self.lookup(kind, key)
+        if entry is None or not entry.fresh:
+            self.stats.count("misses")
+            return None
+        self.stats.count("hits")
+        return entry.value
+
+    def put(self, kind: str, key: str, value: Any, ttl: Optional[float] = None, etag: Optional[str] = None):
+        ttl = TTL[kind] if ttl is None else ttl
+        if ttl <= 0 and etag is None:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (kind, key, json.dumps(value), etag, time.time() + ttl),
+            )
+
+    def touch(self, kind: str, key: str, ttl: Optional[float] = None):
+        """Extend the lifetime of an entry which is still valid."""
+        ttl = TTL[kind] if ttl is None else ttl
+        with self._lock:
+            self._db.execute("UPDATE entries SET expires = ? WHERE kind = ? AND key = ?", (time.time() + ttl, kind, key))
+
+    def invalidate(self, kind: str, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+
+    def cached(self, kind: str, key: str, fetch: Callable[[], Any]) -> Any:
+        """Return the cached value, or the result of `fetch` which is then cached."""
+        value = self.get(kind, key)
+        if value is None:
+            value = fetch()
+            if value is not None:
+                self.put(kind, key, value)
+        return value
+
+    def conditional_headers(self, entry: Optional[Entry]) -> Dict[str, str]:
+        return {"If-None-Match": entry.etag} if entry is not None and entry.etag else {}
+
+    def store_response(self, kind: str, key: str, response: httpx.Response, entry: Optional[Entry]) -> str:
+        """
+        Cache the text of the response to a request made with
+        `conditional_headers(entry)` and return it, or the cached text when
+        the server says it hasn't changed.
+        """
+        ttl = max_age(response)
+        if response.status_code == 304 and entry is not None:
+            self.stats.count("revalidated")
+            self.touch(kind, key, ttl)
+            return entry.value
+
+        response.raise_for_status()
+        self.put(kind, key, response.text, ttl, response.headers.get("etag"))
+        return response.text
+
+
+stats = CacheStats()
+
+_cache: Optional[MetadataCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> MetadataCache:
+    """The shared metadata cache, opened on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = MetadataCache()
+        return _cache
+
+
+def cached_get(client: httpx.Client, kind: str, key: str, url: str, **kwargs) -> str:
+    """GET `url` through the cache, revalidating expired entries when the server gave an ETag."""
+    cache = get_cache()
+    entry = cache.lookup(kind, key)
+    if entry is not None and entry.fresh:
+        stats.count("hits")
+        return entry.value
+
+    stats.count("misses")
+    headers = {**kwargs.pop("headers", {}), **cache.conditional_headers(entry)}
+    return cache.store_response(kind, key, client.get(url, headers=headers, **kwargs), entry)
+
@@ -0,0 +1,102 @@
+import asyncio
+import httpx
+import importlib.util
+import logging
+import threading
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+from weakref import WeakKeyDictionary
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = 30
+"""
+Number of seconds to wait before aborting when there is no network activity.
+https://www.python-httpx.org/advanced/#timeout-configuration
+"""
+
+LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=64, keepalive_expiry=60)
+"""Connection pool limits, shared by the sync and async clients."""
+
+HTTP2 = importlib.util.find_spec("h2") is not None
+"""Use HTTP/2 where the server supports it, requires the `h2` package."""
+
+
+@dataclass
+class ConnectionStats:
+    """Counts requests against new connections, to see how well connections are reused."""
+    requests: int = 0
+    connections: int = 0
+    tls_handshakes: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def __str__(self):
+        return f"{self.requests} requests over {self.connections} connections ({self.tls_handshakes} TLS handshakes)"
+
+
+stats = ConnectionStats()
+
+_options: Dict[str, Any] = {}
+_client: Optional[httpx.Client] = None
+_client_lock = threading.Lock()
+_async_clients: "WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = WeakKeyDictionary()
+
+
+def _trace(event_name: str, info: Dict[str, Any]):
+    if event_name == "connection.connect_tcp.complete":
+        stats.count("connections")
+    elif event_name == "connection.start_tls.complete":
+        stats.count("tls_handshakes")
+
+
+async def _async_trace(event_name: str, info: Dict[str, Any]):
+    _trace(event_name, info)
+
+
+def _on_request(request: httpx.Request):
+    stats.count("requests")
+    request.extensions["trace"] = _trace
+
+
+async def _on_async_request(request: httpx.Request):
+    stats.count("requests")
+    request.extensions["trace"] = _async_trace
+
+
+def configure(limits: Optional[httpx.Limits] = None, http2: Optional[bool] = None, timeout: Optional[float] = None):
+    """Change the client options, clients created before keep their options."""
+    global _client
+    for name, value in (("limits", limits), ("http2", http2), ("timeout", timeout)):
+        if value is not None:
+            _options[name] = value
+
+    with _client_lock:
+        _client = None
+
+
+def _client_options() -> Dict[str, Any]:
+    return {"limits": LIMITS, "http2": HTTP2, "timeout": TIMEOUT, **_options}
+
+
+def get_client() -> httpx.Client:
+    """The shared client for blocking requests, safe to use from any thread."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(event_hooks={"request": [_on_request]}, **_client_options())
+        return _client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """The shared client for requests on the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(event_hooks={"request": [_on_async_request]}, **_client_options())
+        _async_clients[loop] = client
+    return client
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+
+from statistics import median
+from typing import List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+INITIAL_WORKERS = 4
+"""Number of concurrent segment downloads to start with."""
+
+MIN_WORKERS = 1
+MAX_WORKERS = 64
+
+ADJUST_INTERVAL = 0.5
+"""Minimum number of seconds between two adjustments of the limit."""
+
+MIN_SAMPLES = 3
+"""Minimum number of finished requests needed before adjusting the limit."""
+
+ERROR_THRESHOLD = 0.1
+"""Error rate above which the limit is decreased multiplicatively."""
+
+LATENCY_TOLERANCE = 2.0
+"""Decrease the limit when time-to-first-byte grows over this multiple of the best seen."""
+
+GAIN_THRESHOLD = 0.05
+"""Relative throughput gain required to keep growing the limit."""
+
+
+class AdaptiveConcurrency:
+    """
+    Limit the number of in-flight requests, adjusting the limit to the link.
+
+    Starts with a TCP-like slow start, doubling the limit while throughput
+    keeps improving. After that the limit is increased additively while it
+    pays off, and decreased multiplicatively on errors or by one when the
+    time-to-first-byte shows requests are queueing up at the server.
+    """
+
+    def __init__(
+        self,
+        initial: int = INITIAL_WORKERS,
+        minimum: int = MIN_WORKERS,
+        maximum: int = MAX_WORKERS,
+    ):
+        self.minimum: int = minimum
+        self.maximum: int = maximum
+        self.limit: int = max(minimum, min(initial, maximum))
+        self.in_flight: int = 0
+        self.history: List[Tuple[float, int]] = [(time.monotonic(), self.limit)]
+        """Pairs of (timestamp, limit), appended every time the limit changes."""
+
+        self._condition = asyncio.Condition()
+        self._slow_start = True
+        self._min_ttfb: Optional[float] = None
+        self._last_throughput: Optional[float] = None
+        self._last_limit: int = self.limit
+        self._reset_window()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def record(self, size: int, ttfb: float, error: bool = False):
+        """Called every time a request finishes, successfully or not."""
+        self._count += 1
+        self._bytes += size
+        if error:
+            self._errors += 1
+        else:
+            self._ttfbs.append(ttfb)
+
+        elapsed = time.monotonic() - self._window_start
+        if elapsed >= ADJUST_INTERVAL and self._count >= MIN_SAMPLES:
+            self._adjust(self._bytes / elapsed)
+
+    def _adjust(self, throughput: float):
+        error_rate = self._errors / self._count
+        ttfb = median(self._ttfbs) if self._ttfbs else None
+        if ttfb is not None and (self._min_ttfb is None or ttfb < self._min_ttfb):
+            self._min_ttfb = ttfb
+
+        if error_rate > ERROR_THRESHOLD:
+            self._slow_start = False
+            limit = self.limit // 2
+        elif ttfb is not None and ttfb > self._min_ttfb * LATENCY_TOLERANCE:
+            self._slow_start = False
+            limit = self.limit - 1
+        elif self._last_throughput is not None and self.limit > self._last_limit \
+                and throughput < self._last_throughput * (1 + GAIN_THRESHOLD):
+            # Growing the limit did not pay off, go back to where we were
+            self._slow_start = False
+            limit = self._last_limit
+        elif self._slow_start:
+            limit = self.limit * 2
+        else:
+            limit = self.limit + 1
+
+        self._last_throughput = throughput
+        self._last_limit = self.limit
+        self._set_limit(limit)
+        self._reset_window()
+
+    def _set_limit(self, limit: int):
+        limit = max(self.minimum, min(limit, self.maximum))
+        if limit == self.limit:
+            return
+
+        logger.info(f"Concurrency limit {self.limit} -> {limit}")
+        self.limit = limit
+        self.history.append((time.monotonic(), limit))
+
+        # Wake up waiters when the limit grows, tasks over the limit will
+        # finish normally when it shrinks
+        async def notify():
+            async with self._condition:
+                self._condition.notify_all()
+
+        asyncio.ensure_future(notify())
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._count = 0
+        self._errors = 0
+        self._bytes = 0
+        self._ttfbs: List[float] = []
+
+
+class FixedConcurrency:
+    """Used when the number of workers is given explicitly."""
+
+    def __init__(self, workers: int):
+        self.limit: int = workers
+        self.maximum: int = workers
+        self.history: List[Tuple[float, int]] = [(time.monotonic(), workers)]
+        self._semaphore = asyncio.Semaphore(workers)
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+
+    async def __aexit__(self, *exc_info):
+        self._semaphore.release()
+
+    def record(self, size: int, ttfb: float, error: bool = False):
+        pass
+
+
+AnyConcurrency = Union[AdaptiveConcurrency, FixedConcurrency]
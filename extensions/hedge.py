@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import time
+
+from inspect import isawaitable
+from statistics import quantiles
+from typing import Awaitable, Callable, List, Optional, TypeVar
+
+from extensions.progess import Progress
+from extensions.scheduler import detached
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MB = 1024 * 1024
+
+HEDGE_PERCENTILE = 90
+"""Percentile of the segment times, which multiplied by HEDGE_FACTOR makes a segment slow."""
+
+HEDGE_FACTOR = 1.5
+
+MIN_HEDGE_SAMPLES = 10
+"""Number of finished segments needed before any segment is considered slow."""
+
+MAX_HEDGE_RATIO = 0.05
+"""
+Share of the estimated total bytes which may be downloaded twice, at
+least one segment is always allowed. 0 disables hedging, but segment times
+are still measured.
+"""
+
+
+def percentile(values: List[float], n: int) -> float:
+    return quantiles(values, n=100, method="inclusive")[n - 1] if len(values) > 1 else values[0]
+
+
+class Endgame:
+    """
+    Hedge requests for slow segments at the end of a download. Once every
+    segment is started and fewer are left than the concurrency limit, a
+    segment which takes much longer than the others gets a second request,
+    and whichever finishes first is used. This keeps a single slow
+    connection from holding up the whole download.
+
+    Hedged requests report to their own `progress`, so the bytes they
+    duplicate don't show up in the progress of the download.
+    """
+
+    def __init__(self, count: int, concurrency, progress: Progress, max_ratio: float = MAX_HEDGE_RATIO):
+        self.count: int = count
+        self.concurrency = concurrency
+        self.main_progress = progress
+        self.progress = Progress(count)
+        self.max_ratio: float = max_ratio
+        self.started: int = 0
+        self.finished: int = 0
+        self.hedged: int = 0
+        self.won: int = 0
+        """Number of hedged requests which finished before the original one."""
+        self.times: List[float] = []
+        """Time each segment took from the first request until it was downloaded."""
+
+        self._reserved: float = 0
+        self._active = asyncio.Event()
+
+    def threshold(self) -> Optional[float]:
+        if len(self.times) < MIN_HEDGE_SAMPLES:
+            return None
+        return percentile(self.times, HEDGE_PERCENTILE) * HEDGE_FACTOR
+
+    def _segment_size(self) -> Optional[float]:
+        progress = self.main_progress
+        return progress.size_sum / progress.size_count if progress.size_count else None
+
+    def _may_hedge(self) -> bool:
+        """Whether another segment fits in the budget of duplicated bytes."""
+        segment = self._segment_size()
+        if segment is None or self.max_ratio <= 0:
+            return False
+        budget = max(segment * self.count * self.max_ratio, segment)
+        return self._reserved + segment <= budget
+
+    def _update(self):
+        if self.started >= self.count and self.count - self.finished < self.concurrency.limit:
+            self._active.set()
+
+    async def _wait_until_slow(self, primary: asyncio.Future, started: float) -> bool:
+        """Wait until `primary` is done, returns False when it's slow enough to hedge first."""
+        active = asyncio.ensure_future(self._active.wait())
+        try:
+            await asyncio.wait({primary, active}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            active.cancel()
+
+        while not primary.done():
+            threshold = self.threshold()
+            if threshold is None or not self._may_hedge():
+                await asyncio.wait({primary})
+                break
+
+            delay = started + threshold - time.monotonic()
+            if delay <= 0:
+                return False
+            await asyncio.wait({primary}, timeout=delay)
+
+        return True
+
+    async def run(self, task_id: int, attempt: Callable[[bool], Awaitable[T]], tmp_file: Callable[[bool], str]) -> T:
+        """
+        Call `attempt(False)`, and `attempt(True)` as well when the segment
+        turns out to be slow. `tmp_file(hedge)` is the partial file each
+        attempt writes to, it's removed for the attempt which loses.
+        """
+        self.started += 1
+        self._update()
+        started = time.monotonic()
+        primary = asyncio.ensure_future(attempt(False))
+        try:
+            if await self._wait_until_slow(primary, started) or not self._may_hedge():
+                result = await primary
+            else:
+                logger.info(f"Task {task_id}: slow after {time.monotonic() - started:.1f}s, hedging")
+                self.hedged += 1
+                self._reserved += self._segment_size()
+                # The hedged request rides on the slot of the original one
+                hedge = asyncio.ensure_future(detached(attempt(True)))
+                result = await self._race(task_id, primary, hedge, tmp_file)
+
+            if result is not None:
+                self.times.append(time.monotonic() - started)
+            return result
+        finally:
+            primary.cancel()
+            await asyncio.gather(primary, return_exceptions=True)
+            self.finished += 1
+            self._update()
+
+    async def _race(self, task_id: int, primary: asyncio.Future, hedge: asyncio.Future, tmp_file: Callable[[bool], str]):
+        pending = {primary, hedge}
+        finished = set()
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                finished |= done
+                # Prefer the original request when both finished
+                succeeded = [future for future in (primary, hedge) if future in done and future.exception() is None]
+                if succeeded or not pending:
+                    winner = (succeeded or list(done))[0]
+                    if winner is hedge:
+                        self.won += 1
+                        self._count_hedge(task_id)
+                    finished.discard(winner)
+                    return winner.result()
+        finally:
+            for loser in pending:
+                loser.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for loser in pending | finished:
+                if not loser.cancelled() and loser.exception() is None and isawaitable(loser.result()):
+                    # Both finished at once, the loser already queued renaming
+                    # its file onto the target as well
+                    await asyncio.gather(loser.result(), return_exceptions=True)
+                path = tmp_file(loser is hedge)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _count_hedge(self, task_id: int):
+        """Replace the progress of the original request with the hedged one which won."""
+        if task_id in self.main_progress.tasks:
+            self.main_progress.abort(task_id)
+        if task_id in self.progress.tasks:
+            self.main_progress.already_downloaded(task_id, self.progress.tasks[task_id].size)
+
+    def log(self):
+        if not self.times:
+            return
+        logger.info(
+            f"Segment times p50 {percentile(self.times, 50):.2f}s, p99 {percentile(self.times, 99):.2f}s, "
+            f"{self.hedged} hedged requests ({self.won} won), {self.progress.downloaded / MB:.1f}MB duplicated"
+        )
@@ -2,66 +2,147 @@ import asyncio
 import httpx
 import logging
 import os
+import re
 import time
 
-from typing import List, Optional, Union, Callable
+from typing import AsyncIterator, Awaitable, Dict, List, Optional, Sequence, Tuple, TypeVar, Union, Callable
 
-from extensions.progess import Progress
+from extensions.buffers import fill_buffers
+from extensions.clients import get_async_client
+from extensions.concurrency import AdaptiveConcurrency, AnyConcurrency, FixedConcurrency
+from extensions.hedge import MAX_HEDGE_RATIO, Endgame
+from extensions.integrity import IntegrityError, SegmentVerifier, is_ts
+from extensions.jobs import Job
+from extensions.origins import Origins
+from extensions.progess import Progress, Subscriber
+from extensions.retries import AnyURL, is_retryable, retry_async
+from extensions.scheduler import Watermark, run_in_order
+from extensions.writer import FileWriter
 
 logger = logging.getLogger(__name__)
 
-KB = 1024
-
-CHUNK_SIZE = 256 * KB
-"""How much of a VOD to download in each iteration"""
-
-RETRY_COUNT = 5
-"""Number of times to retry failed downloads before aborting."""
-
-TIMEOUT = 30
-"""
-Number of seconds to wait before aborting when there is no network activity.
-https://www.python-httpx.org/advanced/#timeout-configuration
-"""
+T = TypeVar("T")
 
 
 class TokenBucket:
-    """Limit the download speed by strategically inserting sleeps."""
+    """Limit the download speed by strategically inserting sleeps.
+
+    A single bucket is shared by all download tasks, so the rate limit applies
+    to the combined speed. Sleeping is done with `asyncio.sleep` so that a task
+    waiting for tokens does not block the other downloads on the event loop.
+    """
 
     def __init__(self, rate: int, capacity: Optional[int] = None):
         self.rate: int = rate
         self.capacity: int = capacity or rate * 2
-        self.available: int = 0
-        self.last_refilled: float = time.time()
+        self.available: float = self.capacity
+        self.last_refilled: float = time.monotonic()
 
-    def advance(self, size: int):
+    async def advance(self, size: int):
         """Called every time a chunk of data is downloaded."""
         self._refill()
 
-        if self.available < size:
-            deficit = size - self.available
-            time.sleep(deficit / self.rate)
-
+        # Take the tokens right away, going into debt if needed. Tasks which
+        # arrive while the bucket is in debt wait for their share on top of
+        # the existing deficit, which keeps the combined rate at `rate`.
         self.available -= size
+        if self.available < 0:
+            await asyncio.sleep(-self.available / self.rate)
 
     def _refill(self):
         """Increase available capacity according to elapsed time since last refill."""
-        now = time.time()
+        now = time.monotonic()
         elapsed = now - self.last_refilled
-        refill_amount = int(elapsed * self.rate)
-        self.available = min(self.available + refill_amount, self.capacity)
+        self.available = min(self.available + elapsed * self.rate, self.capacity)
         self.last_refilled = now
 
 
 class EndlessTokenBucket:
     """Used when download speed is not limited."""
-    def advance(self, size: int):
+    async def advance(self, size: int):
         pass
 
 
 AnyTokenBucket = Union[TokenBucket, EndlessTokenBucket]
 
 
+class ResumeFailed(Exception):
+    """Raised when a partial download cannot be continued with a range request."""
+    pass
+
+
+class SourceExpired(Exception):
+    """Raised when the server refuses a source, usually because its access token expired."""
+    pass
+
+
+HEDGE_SUFFIX = ".hedge.tmp"
+"""Suffix of the partial file of a hedged request, next to the one of the original request."""
+
+REFRESH_COUNT = 3
+"""Number of times to refresh expired sources of a task before aborting."""
+
+
+class Sources:
+    """
+    The sources of a download, which can be replaced all at once when they
+    expire. Tasks which find their source expired at the same time cause
+    only one refresh.
+    """
+
+    def __init__(self, sources: List[str], refresh: Optional[Callable[[], Awaitable[List[str]]]] = None):
+        self.urls: List[str] = list(sources)
+        self.refresh = refresh
+        self.generation: int = 0
+        self._lock = asyncio.Lock()
+
+    async def renew(self, generation: int):
+        """Refresh the sources, unless they changed since `generation`."""
+        if self.refresh is None:
+            raise SourceExpired("Source expired and can't be refreshed")
+
+        async with self._lock:
+            if generation == self.generation:
+                logger.info("Sources expired, refreshing")
+                self.urls = list(await self.refresh())
+                self.generation += 1
+
+
+def resume_offset(response: httpx.Response, offset: int) -> int:
+    """
+    Return the offset at which the body of a response to a range request
+    starts, or 0 when it contains the whole file. Raises `ResumeFailed` when
+    the server responds with a range which doesn't continue the partial file.
+    """
+    if not offset or response.status_code == 200:
+        return 0
+
+    if response.status_code != 206:
+        raise ResumeFailed(f"Unexpected status {response.status_code} for range request")
+
+    match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", response.headers.get("content-range", ""))
+    if not match or int(match.group(1)) != offset or int(match.group(2)) < offset:
+        raise ResumeFailed(f"Content-Range {response.headers.get('content-range')} does not continue the file at {offset}")
+
+    return offset
+
+
+def body(response: httpx.Response) -> AsyncIterator[bytes]:
+    """
+    The body of a response in the pieces read from the network, without
+    joining them into chunks. Only decoded when the server compressed it.
+    """
+    if response.headers.get("content-encoding", "identity") != "identity":
+        return response.aiter_bytes()
+    return response.aiter_raw()
+
+
+def range_headers(tmp_target: str) -> Tuple[int, Dict[str, str]]:
+    """Return the size of a partially downloaded file and headers to request the rest."""
+    offset = os.path.getsize(tmp_target) if os.path.exists(tmp_target) else 0
+    return offset, {"Range": f"bytes={offset}-"} if offset else {}
+
+
 async def download(
     client: httpx.AsyncClient,
     task_id: int,
@@ -69,62 +150,241 @@ async def download(
     target: str,
     progress: Progress,
     token_bucket: AnyTokenBucket,
+    concurrency: AnyConcurrency,
+    writer: FileWriter,
+    tmp_suffix: str = ".tmp",
 ):
     # Download to a temp file first, then copy to target when over to avoid
-    # getting saving chunks which may persist if canceled or --keep is used
-    tmp_target = f"{target}.tmp"
-    with open(tmp_target, "wb") as f:
-        async with client.stream("GET", source) as response:
-            size = int(response.headers.get("content-length"))
-            progress.start(task_id, size)
-            async for chunk in response.aiter_bytes(chunk_size=CHUNK_SIZE):
-                f.write(chunk)
-                size = len(chunk)
-                token_bucket.advance(size)
-                progress.advance(task_id, size)
-            progress.end(task_id)
-    os.rename(tmp_target, target)
+    # getting saving chunks which may persist if canceled or --keep is used.
+    # A temp file left over from a failed attempt is resumed with a range request.
+    tmp_target = target + tmp_suffix
+    offset, headers = range_headers(tmp_target)
+    started = time.monotonic()
+    received = 0
+    async with client.stream("GET", source, headers=headers) as response:
+        ttfb = time.monotonic() - started
+        if response.status_code in (401, 403):
+            raise SourceExpired(f"Task {task_id}: status {response.status_code}")
+        if response.status_code != 416:
+            # 416 is a range which can't be resumed, handled below
+            response.raise_for_status()
+
+        try:
+            offset = resume_offset(response, offset)
+        except ResumeFailed as e:
+            logger.warning(f"Task {task_id}: {e}, restarting download")
+            os.remove(tmp_target)
+            return await download(client, task_id, source, target, progress, token_bucket, concurrency, writer, tmp_suffix)
+
+        # Chunked responses, like some clips, don't tell the length
+        length = response.headers.get("content-length")
+        size = offset + int(length) if length is not None else None
+        progress.start(task_id, size, downloaded=offset)
+        # Targets are always named .ts, the source tells what the segment is
+        verifier = SegmentVerifier(size, offset, ts=is_ts(source))
+        try:
+            async with writer.open(tmp_target, "ab" if offset else "wb") as f:
+                # Pieces from the network are gathered in pooled buffers,
+                # which go back to the pool once they're on disk
+                async for buffer, size in fill_buffers(body(response), writer.buffers):
+                    with memoryview(buffer)[:size] as chunk:
+                        verifier.update(chunk)
+                    await f.write_buffer(buffer, size)
+                    received += size
+                    await token_bucket.advance(size)
+                    progress.advance(task_id, size)
+                verifier.finish()
+        except IntegrityError:
+            # Don't resume from a corrupt partial file
+            os.remove(tmp_target)
+            raise
+        progress.end(task_id)
+    concurrency.record(received, ttfb)
+    return f.commit(target)
+
+
+async def download_to_memory(
+    client: httpx.AsyncClient,
+    task_id: int,
+    source: str,
+    progress: Progress,
+    token_bucket: AnyTokenBucket,
+    concurrency: AnyConcurrency,
+) -> bytearray:
+    """Like `download`, but returns the data instead of writing it to a file."""
+    data = bytearray()
+    started = time.monotonic()
+    async with client.stream("GET", source) as response:
+        ttfb = time.monotonic() - started
+        response.raise_for_status()
+        length = response.headers.get("content-length")
+        size = int(length) if length is not None else None
+        progress.start(task_id, size)
+        verifier = SegmentVerifier(size, ts=is_ts(source))
+        async for chunk in body(response):
+            verifier.update(chunk)
+            data += chunk
+            size = len(chunk)
+            await token_bucket.advance(size)
+            progress.advance(task_id, size)
+        verifier.finish()
+        progress.end(task_id)
+    concurrency.record(len(data), ttfb)
+    return data
+
+
+async def retry(
+    task_id: int,
+    source: AnyURL,
+    progress: Progress,
+    concurrency: AnyConcurrency,
+    attempt: Callable[[str], Awaitable[T]],
+) -> T:
+    """
+    Call `attempt(url)` until it succeeds, as often and with the backoff of
+    the default `RetryPolicy`, holding back while the host of `source` is
+    failing.
+    """
+    async def attempt_once(url: str):
+        try:
+            return await attempt(url)
+        except (httpx.HTTPError, IntegrityError) as e:
+            # Errors like a 404 say nothing about the link, and shouldn't
+            # shrink the workers shared with other jobs
+            if is_retryable(e):
+                concurrency.record(0, 0, error=True)
+            if task_id in progress.tasks:
+                progress.abort(task_id)
+            raise
+
+    def failed(e: BaseException, n: int, delay: float):
+        logger.warning(f"Task {task_id} failed: {e!r}. Retrying in {delay:.1f}s")
+
+    return await retry_async(source, attempt_once, failed)
 
 
 async def download_with_retries(
     client: httpx.AsyncClient,
-    semaphore: asyncio.Semaphore,
+    concurrency: AnyConcurrency,
     task_id: int,
     source: str,
     target: str,
     progress: Progress,
     token_bucket: AnyTokenBucket,
+    writer: FileWriter,
+    tmp_suffix: str = ".tmp",
+    origins: Optional[Origins] = None,
 ):
-    async with semaphore:
-        if os.path.exists(target):
-            size = os.path.getsize(target)
-            progress.already_downloaded(task_id, size)
-            return
-
-        for n in range(RETRY_COUNT):
-            try:
-                return await download(client, task_id, source, target, progress, token_bucket)
-            except httpx.RequestError:
-                logger.exception("Task {task_id} failed. Retrying. Maybe.")
-                progress.abort(task_id)
-                if n + 1 >= RETRY_COUNT:
-                    raise
+    if os.path.exists(target):
+        size = os.path.getsize(target)
+        progress.already_downloaded(task_id, size)
+        return
+
+    if origins is None:
+        return await retry(task_id, source, progress, concurrency, lambda url: download(
+            client, task_id, url, target, progress, token_bucket, concurrency, writer, tmp_suffix))
 
-        raise Exception("Should not happen")
+    async def attempt(url: str):
+        started = time.monotonic()
+        try:
+            result = await download(client, task_id, url, target, progress, token_bucket, concurrency, writer, tmp_suffix)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404 and origins.drop(url):
+                # An alternate host which doesn't have the segment, try the others
+                return await attempt(origins.url(source))
+            origins.record(url, 0, time.monotonic() - started, error=True)
+            raise
+        except (httpx.TransportError, IntegrityError):
+            origins.record(url, 0, time.monotonic() - started, error=True)
+            raise
+        origins.record(url, progress.tasks[task_id].size, time.monotonic() - started)
+        return result
+
+    return await retry(task_id, lambda: origins.url(source), progress, concurrency, attempt)
+
+
+def log_concurrency(concurrency: AnyConcurrency):
+    history = ", ".join(f"{t - concurrency.history[0][0]:.1f}s: {limit}" for t, limit in concurrency.history)
+    logger.info(f"Concurrency over time: {history}")
 
 
 async def download_all(
     progresstxt: Callable,
     sources: List[str],
     targets: List[str],
-    workers: int,
+    workers: Optional[int] = None,
     *,
-    rate_limit: Optional[int] = None
+    rate_limit: Optional[int] = None,
+    watermark: Optional[Watermark] = None,
+    subscribers: Sequence[Subscriber] = (),
+    failed: Optional[Dict[int, Exception]] = None,
+    refresh: Optional[Callable[[], Awaitable[List[str]]]] = None,
+    job: Optional[Job] = None,
+    hedge: bool = True,
+    origins: Optional[Origins] = None,
 ):
-    progress = Progress(len(sources), progress_txt=progresstxt)
+    """
+    Download all sources to their targets. When `workers` is not given, the
+    number of concurrent downloads is adjusted to the link as it goes.
+
+    Sources are started in order, pass a `watermark` to get notified as the
+    complete prefix of targets grows. Progress is reported to `progresstxt`,
+    the terminal and any additional `subscribers`.
+
+    By default the first source which fails stops the download. For
+    independent files pass a `failed` dict, which gets the exception of
+    every failed source by index while the others continue.
+
+    Sources which are refused with 401 or 403 are replaced by the result
+    of `refresh`, like playlists fetched with a new access token.
+
+    Pass a `job` of the shared `JobScheduler` to run alongside other
+    downloads on its workers, instead of with a concurrency limit of its own.
+
+    Unless `hedge` is False, slow segments at the end of the download get
+    a second request, see `Endgame`.
+
+    Pass `origins` to fetch from other hosts serving the same segments
+    when the one of the sources degrades mid-download.
+    """
+    progress = Progress(len(sources), progress_txt=progresstxt, job=job)
+    for subscriber in subscribers:
+        progress.subscribe(subscriber)
     token_bucket = TokenBucket(rate_limit) if rate_limit else EndlessTokenBucket()
-    async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-        semaphore = asyncio.Semaphore(workers)
-        tasks = [download_with_retries(client, semaphore, task_id, source, target, progress, token_bucket)
-                 for task_id, (source, target) in enumerate(zip(sources, targets))]
-        await asyncio.gather(*tasks)
+    concurrency = job or (FixedConcurrency(workers) if workers else AdaptiveConcurrency())
+    writer = FileWriter()
+    urls = Sources(sources, refresh)
+    endgame = Endgame(len(sources), concurrency, progress, MAX_HEDGE_RATIO if hedge else 0)
+
+    def tmp_suffix(hedged: bool) -> str:
+        return HEDGE_SUFFIX if hedged else ".tmp"
+
+    try:
+        client = get_async_client()
+        async with progress.reporting():
+            async def attempt(task_id: int, hedged: bool):
+                for n in range(REFRESH_COUNT):
+                    generation = urls.generation
+                    try:
+                        return await download_with_retries(
+                            client, concurrency, task_id, urls.urls[task_id], targets[task_id],
+                            endgame.progress if hedged else progress, token_bucket, writer, tmp_suffix(hedged), origins)
+                    except SourceExpired:
+                        if n + 1 >= REFRESH_COUNT:
+                            raise
+                        await urls.renew(generation)
+
+            async def fetch(task_id: int):
+                return await endgame.run(
+                    task_id, lambda hedged: attempt(task_id, hedged), lambda hedged: targets[task_id] + tmp_suffix(hedged))
+
+            await run_in_order(len(sources), concurrency, fetch, watermark, failed)
+    finally:
+        await writer.aclose()
+
+    log_concurrency(concurrency)
+    logger.info(f"Chunk buffers: {writer.buffers}")
+    endgame.log()
+    if origins is not None:
+        origins.log()
+    return concurrency.history
@@ -0,0 +1,128 @@
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = b"\x47"
+
+PAT_PID = 0
+PMT_TABLE_ID = 0x02
+
+HEAD_SIZE = 64 * TS_PACKET_SIZE
+"""How far into a segment to look for the PAT and PMT."""
+
+READ_SIZE = 1024 * 1024
+"""Chunk size used when verifying files on disk."""
+
+
+class IntegrityError(Exception):
+    """Raised when a downloaded segment is incomplete or not valid MPEG-TS."""
+    pass
+
+
+def is_ts(source: str) -> bool:
+    """Whether the segment at URL or path `source` is MPEG-TS, going by its name."""
+    return urlparse(source).path.endswith(".ts")
+
+
+def _packet_tables(head: bytes):
+    """Yield (pid, table_id) of every packet in `head` which starts a table section."""
+    for start in range(0, len(head) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        packet = head[start:start + TS_PACKET_SIZE]
+        if not packet[1] & 0x40:
+            # No payload unit start, so no new section
+            continue
+
+        pid = ((packet[1] & 0x1F) << 8) | packet[2]
+        adaptation = (packet[3] >> 4) & 0x3
+        payload = 4
+        if adaptation in (2, 3):
+            payload += 1 + packet[4]
+        if adaptation == 2 or payload >= TS_PACKET_SIZE:
+            continue
+
+        # Skip the pointer field to the start of the section
+        section = payload + 1 + packet[payload]
+        if section < TS_PACKET_SIZE:
+            yield pid, packet[section]
+
+
+class SegmentVerifier:
+    """
+    Check a segment while it is streamed, chunk by chunk. Verifies the
+    length against the expected one, and for MPEG-TS that a sync byte
+    starts every 188 byte packet and that a PAT and PMT are present.
+    `offset` is where the data starts in the file, for resumed downloads.
+    """
+
+    def __init__(self, expected: Optional[int] = None, offset: int = 0, ts: bool = True):
+        self.expected: Optional[int] = expected
+        self.position: int = offset
+        self.ts: bool = ts
+        # The head of a resumed download was checked by an earlier attempt,
+        # the file is checked as a whole before joining
+        self._head: Optional[bytearray] = bytearray() if ts and offset == 0 else None
+
+    def update(self, chunk: bytes):
+        if self.ts:
+            first = -self.position % TS_PACKET_SIZE
+            sync = bytes(memoryview(chunk)[first::TS_PACKET_SIZE])
+            if sync.strip(SYNC_BYTE):
+                raise IntegrityError(f"MPEG-TS sync byte missing after byte {self.position + first}")
+
+            if self._head is not None and len(self._head) < HEAD_SIZE:
+                self._head += chunk[:HEAD_SIZE - len(self._head)]
+
+        self.position += len(chunk)
+
+    def finish(self):
+        """Raise `IntegrityError` when the segment is incomplete or invalid."""
+        if self.expected is not None and self.position != self.expected:
+            raise IntegrityError(f"Expected {self.expected} bytes, got {self.position}")
+
+        if not self.ts:
+            return
+
+        if self.position % TS_PACKET_SIZE:
+            raise IntegrityError(f"Segment ends with a partial packet, {self.position} bytes")
+
+        if self._head is not None:
+            tables = set(_packet_tables(self._head))
+            if not any(pid == PAT_PID for pid, _ in tables):
+                raise IntegrityError("MPEG-TS segment has no PAT")
+            if not any(table_id == PMT_TABLE_ID for _, table_id in tables):
+                raise IntegrityError("MPEG-TS segment has no PMT")
+
+
+def verify_file(path: str, expected: Optional[int] = None, ts: bool = True):
+    """
+    Raise `IntegrityError` when the file at `path` isn't a complete, valid
+    segment. Pass `ts` False for segments which aren't MPEG-TS, the name of
+    the file doesn't tell.
+    """
+    verifier = SegmentVerifier(expected, ts=ts)
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_SIZE):
+            verifier.update(chunk)
+    verifier.finish()
+
+
+def _is_valid(path: str, ts: bool) -> bool:
+    try:
+        verify_file(path, ts=ts)
+    except (IntegrityError, OSError) as e:
+        logger.warning(f"{path}: {e}")
+        return False
+    return True
+
+
+def verify_files(paths: Sequence[str], workers: Optional[int] = None, ts: bool = True) -> List[int]:
+    """Verify files in parallel, returns the indices of the ones which are invalid or missing."""
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        valid = list(executor.map(_is_valid, paths, [ts] * len(paths)))
+    return [index for index, ok in enumerate(valid) if not ok]
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import time
+
+from collections import deque
+from typing import Awaitable, Callable, Deque, List, NamedTuple, Optional, Tuple, TypeVar
+
+from extensions.concurrency import AdaptiveConcurrency, AnyConcurrency
+from extensions.scheduler import Slot, current_slot
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MB = 1024 * 1024
+
+DEFAULT_REQUEST_SIZE = MB
+"""Assumed size of a request before a job has finished any."""
+
+THROUGHPUT_WINDOW = 5.0
+"""Number of seconds over which the throughput of a job is measured."""
+
+
+class JobStats(NamedTuple):
+    name: str
+    priority: int
+    weight: float
+    paused: bool
+    in_flight: int
+    downloaded: int
+    throughput: float
+    """Bytes per second over the last THROUGHPUT_WINDOW seconds."""
+
+
+class Job:
+    """
+    A download which shares the workers of a `JobScheduler` with all other
+    jobs. It's used in place of the concurrency limiter of a single
+    download, every request waits for the scheduler to give it a slot.
+    """
+
+    def __init__(self, scheduler: "JobScheduler", name: str, priority: int, weight: float):
+        self.scheduler = scheduler
+        self.name: str = name
+        self.priority: int = priority
+        self.weight: float = weight
+        self.paused: bool = False
+        self.in_flight: int = 0
+        self.waiting: int = 0
+        self.downloaded: int = 0
+        self.requests: int = 0
+        self.served: float = 0.0
+        """Bytes served divided by the weight, the job with the least is next."""
+        self.started: float = time.monotonic()
+
+        self._samples: Deque[Tuple[float, int]] = deque()
+
+    @property
+    def limit(self) -> int:
+        return self.scheduler.pool.limit
+
+    @property
+    def maximum(self) -> int:
+        return self.scheduler.pool.maximum
+
+    @property
+    def history(self) -> List[Tuple[float, int]]:
+        return self.scheduler.pool.history
+
+    @property
+    def expected_size(self) -> float:
+        return self.downloaded / self.requests if self.requests else DEFAULT_REQUEST_SIZE
+
+    @property
+    def throughput(self) -> float:
+        self._expire_samples()
+        return sum(size for _, size in self._samples) / THROUGHPUT_WINDOW
+
+    async def __aenter__(self):
+        await self.scheduler._acquire(self, current_slot())
+
+    async def __aexit__(self, *exc_info):
+        await self.scheduler._release(self, current_slot())
+
+    def record(self, size: int, ttfb: float, error: bool = False):
+        """Called every time a request finishes, successfully or not."""
+        slot = current_slot()
+        if slot is not None:
+            slot.transferred += size
+        self.downloaded += size
+        if not error:
+            self.requests += 1
+        self._samples.append((time.monotonic(), size))
+        self._expire_samples()
+
+        limit = self.scheduler.pool.limit
+        self.scheduler.pool.record(size, ttfb, error)
+        if self.scheduler.pool.limit > limit:
+            self.scheduler._wake()
+
+    def pause(self):
+        """Stop giving slots to this job, requests in flight finish normally."""
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.scheduler._wake()
+
+    def stats(self) -> JobStats:
+        return JobStats(self.name, self.priority, self.weight, self.paused, self.in_flight, self.downloaded, self.throughput)
+
+    def _expire_samples(self):
+        horizon = time.monotonic() - THROUGHPUT_WINDOW
+        while self._samples and self._samples[0][0] < horizon:
+            self._samples.popleft()
+
+
+class JobScheduler:
+    """
+    Share one pool of segment workers between any number of concurrent jobs.
+
+    Whenever a worker is free, it goes to a waiting request of the job with
+    the highest priority, so a job with a higher priority preempts the
+    others at the next segment boundary. Between jobs of the same priority
+    the workers are shared by weighted fair queuing: the job which was
+    served the fewest bytes relative to its weight goes next.
+    """
+
+    def __init__(self, pool: Optional[AnyConcurrency] = None):
+        self.pool = pool or AdaptiveConcurrency()
+        """Limits the total number of requests in flight, over all jobs."""
+
+        self.jobs: List[Job] = []
+        self.in_flight: int = 0
+        self._condition = asyncio.Condition()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def add(self, name: str, priority: int = 0, weight: float = 1.0) -> Job:
+        job = Job(self, name, priority, weight)
+        # Start level with the other jobs, instead of getting all slots
+        # until it catches up on what they were served
+        job.served = min((other.served for other in self.jobs), default=0.0)
+        self.jobs.append(job)
+        return job
+
+    def remove(self, job: Job):
+        elapsed = time.monotonic() - job.started
+        logger.info(f"Job {job.name} finished: {job.downloaded / MB:.1f}MB at {job.downloaded / MB / elapsed:.1f}MB/s")
+        self.jobs.remove(job)
+        self._wake()
+
+    def stats(self) -> List[JobStats]:
+        return [job.stats() for job in self.jobs]
+
+    def _next(self) -> Optional[Job]:
+        waiting = [job for job in self.jobs if job.waiting and not job.paused]
+        if not waiting:
+            return None
+        return min(waiting, key=lambda job: (-job.priority, job.served))
+
+    async def _acquire(self, job: Job, slot: Optional[Slot]):
+        self._loop = asyncio.get_running_loop()
+        async with self._condition:
+            job.waiting += 1
+            try:
+                await self._condition.wait_for(lambda: self.in_flight < self.pool.limit and self._next() is job)
+            finally:
+                job.waiting -= 1
+            self.in_flight += 1
+            job.in_flight += 1
+            # Charge what the slot will likely download, so the job doesn't
+            # get all free slots until its first request finishes
+            charge = job.expected_size
+            job.served += charge / job.weight
+            if slot is not None:
+                slot.charge = charge
+                slot.transferred = 0
+            # The next job in line may be able to take a slot as well
+            self._condition.notify_all()
+
+    async def _release(self, job: Job, slot: Optional[Slot]):
+        async with self._condition:
+            self.in_flight -= 1
+            job.in_flight -= 1
+            if slot is not None:
+                # Settle the charge with what was downloaded with the slot
+                job.served += (slot.transferred - slot.charge) / job.weight
+            self._condition.notify_all()
+
+    def _wake(self):
+        """Let waiting requests check again, can be called from any thread."""
+        async def notify():
+            async with self._condition:
+                self._condition.notify_all()
+
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(asyncio.ensure_future, notify())
+
+
+_scheduler: Optional[JobScheduler] = None
+
+
+def get_scheduler() -> JobScheduler:
+    """The scheduler shared by all jobs, must be used from the background loop."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = JobScheduler()
+    return _scheduler
+
+
+async def run_job(name: str, run: Callable[[Job], Awaitable[T]], priority: int = 0, weight: float = 1.0) -> T:
+    """Call `run` with a new job of the shared scheduler, which is removed when it's done."""
+    scheduler = get_scheduler()
+    job = scheduler.add(name, priority, weight)
+    try:
+        return await run(job)
+    finally:
+        scheduler.remove(job)
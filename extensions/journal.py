@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_PATH = "jobs.sqlite"
+"""Where the job journal is stored, next to settings.ini."""
+
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+DONE = "done"
+FAILED = "failed"
+
+UNFINISHED = (QUEUED, DOWNLOADING)
+"""States of jobs which are picked up again after a restart."""
+
+
+class JournalJob(NamedTuple):
+    id: int
+    video: Dict[str, Any]
+    start_sec: Optional[int]
+    end_sec: Optional[int]
+    quality: str
+    state: str
+
+
+class JobJournal:
+    """
+    A record of all download jobs and the state of each of their segments,
+    kept in SQLite so jobs can be picked up again after a crash. Segments
+    are only trusted when their file still has the size recorded when they
+    completed, everything else is downloaded again.
+    """
+
+    def __init__(self, path: str = JOURNAL_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY, video_id TEXT, video TEXT, start_sec INTEGER, end_sec INTEGER, "
+            "quality TEXT, state TEXT, created REAL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            "job_id INTEGER, idx INTEGER, uri TEXT, target TEXT, done INTEGER, size INTEGER, "
+            "PRIMARY KEY (job_id, idx))"
+        )
+
+    def add(self, video: Dict[str, Any], start_sec: Optional[int], end_sec: Optional[int], quality: str = "source") -> int:
+        # Only keep what can be stored, like not the thumbnail pixmap
+        video = {key: value for key, value in video.items() if key != "thumbpix"}
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO jobs (video_id, video, start_sec, end_sec, quality, state, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (video["id"], json.dumps(video), start_sec, end_sec, quality, QUEUED, time.time()),
+            )
+        return cursor.lastrowid
+
+    def set_state(self, job_id: int, state: str):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET state = ? WHERE id = ?", (state, job_id))
+
+    def unfinished(self) -> List[JournalJob]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, video, start_sec, end_sec, quality, state FROM jobs WHERE state IN (?, ?) ORDER BY id",
+                UNFINISHED,
+            ).fetchall()
+        return [JournalJob(id, json.loads(video), start, end, quality, state) for id, video, start, end, quality, state in rows]
+
+    def set_segments(self, job_id: int, uris: Sequence[str], targets: Sequence[str]):
+        """
+        Record the segments of a job. When the job already has the same
+        segments, like after a restart, their state is kept.
+        """
+        with self._lock:
+            known = self._db.execute("SELECT uri, target FROM segments WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+            if known == list(zip(uris, targets)):
+                return
+
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.execute("DELETE FROM segments WHERE job_id = ?", (job_id,))
+                self._db.executemany(
+                    "INSERT INTO segments VALUES (?, ?, ?, ?, 0, NULL)",
+                    [(job_id, index, uri, target) for index, (uri, target) in enumerate(zip(uris, targets))],
+                )
+
+    def segment_done(self, job_id: int, index: int, target: str):
+        size = os.path.getsize(target)
+        with self._lock:
+            self._db.execute("UPDATE segments SET done = 1, size = ? WHERE job_id = ? AND idx = ?", (size, job_id, index))
+
+    def verify(self, job_id: int) -> int:
+        """
+        Remove segment files which can't be trusted so they are downloaded
+        again: files of segments which never completed, which may be
+        truncated after a crash, and completed ones whose size changed.
+        Returns the number of segments which are kept.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT idx, target, done, size FROM segments WHERE job_id = ?", (job_id,)).fetchall()
+
+        kept = 0
+        invalid = []
+        for index, target, done, size in rows:
+            exists = os.path.exists(target)
+            if done and exists and os.path.getsize(target) == size:
+                kept += 1
+                continue
+
+            if exists:
+                os.remove(target)
+            if done:
+                invalid.append((job_id, index))
+
+        if invalid:
+            logger.warning(f"Job {job_id}: {len(invalid)} completed segments are missing or changed")
+            with self._lock:
+                self._db.executemany("UPDATE segments SET done = 0, size = NULL WHERE job_id = ? AND idx = ?", invalid)
+
+        return kept
+
+
+_journal: Optional[JobJournal] = None
+_journal_lock = threading.Lock()
+
+
+def get_journal() -> JobJournal:
+    """The shared job journal, opened on first use."""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = JobJournal()
+        return _journal
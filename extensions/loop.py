@@ -0,0 +1,59 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+from typing import Awaitable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class BackgroundLoop:
+    """
+    An event loop running on its own thread for the lifetime of the app.
+    All async work is submitted to it, so the HTTP clients and their warm
+    connections are shared by every job instead of being rebuilt with a new
+    loop each time.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="event-loop", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine: Awaitable[T]) -> "concurrent.futures.Future[T]":
+        """Schedule `coroutine` on the loop, returns a future which can be waited on from any thread."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: Awaitable[T]) -> T:
+        """Run `coroutine` on the loop and wait for its result, like `asyncio.run`."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("Can't wait for the background loop from its own thread")
+        return self.submit(coroutine).result()
+
+
+_loop: Optional[BackgroundLoop] = None
+_loop_lock = threading.Lock()
+
+
+def get_loop() -> BackgroundLoop:
+    """The shared background loop, started on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = BackgroundLoop()
+        return _loop
+
+
+def submit(coroutine: Awaitable[T]) -> "concurrent.futures.Future[T]":
+    return get_loop().submit(coroutine)
+
+
+def run(coroutine: Awaitable[T]) -> T:
+    return get_loop().run(coroutine)
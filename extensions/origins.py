@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+
+from typing import Awaitable, Callable, List, NamedTuple, Optional
+from urllib.parse import urlparse
+
+from extensions.retries import get_breaker
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+EWMA_WEIGHT = 0.2
+"""Weight of the latest request in the moving averages of a host."""
+
+MIN_REQUESTS = 5
+"""Number of requests to a host before its throughput is trusted."""
+
+ERROR_THRESHOLD = 0.3
+"""Error rate above which a host is considered degraded."""
+
+SWITCH_RATIO = 2.0
+"""Move to another host when it's this many times faster than the current one."""
+
+RESOLVE_INTERVAL = 30.0
+"""Minimum number of seconds between looking up new hosts."""
+
+
+class HostStats(NamedTuple):
+    host: str
+    requests: int
+    errors: int
+    downloaded: int
+    throughput: float
+    """Moving average of the bytes per second of single requests."""
+    error_rate: float
+
+
+class Origin:
+    """A base URI serving the segments, with the health of its host."""
+
+    def __init__(self, base: str):
+        self.base: str = base
+        self.host: str = urlparse(base).netloc
+        self.requests: int = 0
+        self.errors: int = 0
+        self.downloaded: int = 0
+        self.throughput: Optional[float] = None
+        self.error_rate: float = 0.0
+        self.missing: bool = False
+        """Set when the host doesn't have the segments, it's never used again."""
+
+    def record(self, size: int, elapsed: float, error: bool = False):
+        self.requests += 1
+        self.error_rate += EWMA_WEIGHT * (error - self.error_rate)
+        if error:
+            self.errors += 1
+            return
+
+        self.downloaded += size
+        rate = size / max(elapsed, 1e-3)
+        self.throughput = rate if self.throughput is None else self.throughput + EWMA_WEIGHT * (rate - self.throughput)
+
+    @property
+    def degraded(self) -> bool:
+        return self.missing or get_breaker(self.base).is_open or (self.requests >= MIN_REQUESTS and self.error_rate > ERROR_THRESHOLD)
+
+    def stats(self) -> HostStats:
+        return HostStats(self.host, self.requests, self.errors, self.downloaded, self.throughput or 0.0, self.error_rate)
+
+
+class Origins:
+    """
+    The base URIs which serve the same segments, like the same playlist on
+    several CDN hosts. Segments are fetched from the current origin, and
+    the remaining ones move to another origin when the current one is
+    degraded or much slower than one which was tried.
+
+    When every known origin is degraded, `resolve` is called to look up
+    more, like by fetching the master playlist again for a new edge.
+    """
+
+    def __init__(self, bases: List[str], resolve: Optional[Callable[[], Awaitable[List[str]]]] = None):
+        self.origins: List[Origin] = []
+        self.current: Optional[Origin] = None
+        self.resolve = resolve
+        self._resolved: Optional[float] = None
+        self._resolving: Optional[asyncio.Future] = None
+        for base in bases:
+            self.add(base)
+
+    def add(self, base: str):
+        if any(origin.base == base for origin in self.origins):
+            return
+        self.origins.append(Origin(base))
+        if self.current is None:
+            self.current = self.origins[0]
+
+    def _origin_of(self, url: str) -> Optional[Origin]:
+        for origin in self.origins:
+            if url.startswith(origin.base):
+                return origin
+        return None
+
+    def url(self, source: str) -> str:
+        """The URL to fetch `source` from, on the best origin right now."""
+        origin = self._origin_of(source)
+        if origin is None:
+            return source
+        return self._choose().base + source[len(origin.base):]
+
+    def record(self, url: str, size: int, elapsed: float, error: bool = False):
+        origin = self._origin_of(url)
+        if origin is not None:
+            origin.record(size, elapsed, error)
+
+    def drop(self, url: str) -> bool:
+        """
+        Stop using the origin of `url`, after it answered that it doesn't
+        have a segment. Returns False for the first origin, the one the
+        sources came from, which is never dropped.
+        """
+        origin = self._origin_of(url)
+        if origin is None or origin is self.origins[0]:
+            return False
+        if not origin.missing:
+            logger.warning(f"{origin.host} doesn't have the segments, not using it")
+            origin.missing = True
+        if self.current is origin:
+            self.current = self.origins[0]
+        return True
+
+    def _choose(self) -> Origin:
+        current = self.current
+        healthy = [origin for origin in self.origins if origin is not current and not origin.degraded]
+
+        if current.degraded:
+            if not healthy:
+                self._resolve()
+                return current
+            # Prefer hosts which did well before over ones not tried yet
+            best = max(healthy, key=lambda origin: origin.throughput or 0.0)
+            self._switch(best, "degraded")
+        elif current.throughput and current.requests >= MIN_REQUESTS:
+            faster = [origin for origin in healthy if (origin.throughput or 0.0) > current.throughput * SWITCH_RATIO]
+            if faster:
+                self._switch(max(faster, key=lambda origin: origin.throughput), "slow")
+
+        return self.current
+
+    def _switch(self, origin: Origin, reason: str):
+        logger.warning(f"{self.current.host} is {reason}, moving the remaining segments to {origin.host}")
+        self.current = origin
+
+    def _resolve(self):
+        """Look up more origins in the background, at most every RESOLVE_INTERVAL seconds."""
+        if self.resolve is None or self._resolving is not None:
+            return
+        if self._resolved is not None and time.monotonic() - self._resolved < RESOLVE_INTERVAL:
+            return
+
+        async def resolve():
+            try:
+                bases = await self.resolve()
+                for base in bases:
+                    self.add(base)
+                logger.info(f"Resolved origins: {', '.join(origin.host for origin in self.origins)}")
+            except Exception as e:
+                logger.warning(f"Could not resolve origins: {e}")
+            finally:
+                self._resolved = time.monotonic()
+                self._resolving = None
+
+        self._resolving = asyncio.ensure_future(resolve())
+
+    def stats(self) -> List[HostStats]:
+        return [origin.stats() for origin in self.origins]
+
+    def log(self):
+        if len(self.origins) < 2:
+            return
+        hosts = ", ".join(
+            f"{s.host}: {s.downloaded / MB:.1f}MB at {s.throughput / MB:.1f}MB/s, {s.errors}/{s.requests} errors"
+            for s in self.stats() if s.requests
+        )
+        logger.info(f"Origins: {hosts}")
@@ -0,0 +1,212 @@
+import logging
+
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+from weakref import WeakKeyDictionary
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+
+DISCONTINUITY = 1
+"""Segment flag for `#EXT-X-DISCONTINUITY`."""
+
+HEADER_TAGS = (
+    "#EXTM3U",
+    "#EXT-X-VERSION",
+    "#EXT-X-TARGETDURATION",
+    "#EXT-X-PLAYLIST-TYPE",
+    "#EXT-X-MEDIA-SEQUENCE",
+    "#EXT-X-DISCONTINUITY-SEQUENCE",
+    "#EXT-X-INDEPENDENT-SEGMENTS",
+    "#EXT-X-START",
+    "#EXT-X-MAP",
+    "#EXT-X-TWITCH-",
+)
+"""
+Tags before the first segment which apply to the whole playlist. Other
+tags there, like `#EXT-X-PROGRAM-DATE-TIME`, belong to the first segment.
+"""
+
+
+class MediaPlaylist:
+    """
+    A parsed HLS media playlist, stored as parallel arrays instead of an
+    object per segment. Tags which apply to a single segment other than
+    `#EXTINF` and `#EXT-X-DISCONTINUITY` are kept verbatim, but only for
+    the segments which have them.
+    """
+
+    __slots__ = ("header", "footer", "uris", "durations", "titles", "flags", "tags", "__weakref__")
+
+    def __init__(self):
+        self.header: List[str] = []
+        self.footer: List[str] = []
+        self.uris: List[str] = []
+        self.durations = array("d")
+        self.titles: Dict[int, str] = {}
+        self.flags = bytearray()
+        self.tags: Dict[int, List[str]] = {}
+
+    def __len__(self):
+        return len(self.uris)
+
+    @property
+    def segment_map(self) -> List[str]:
+        """`#EXT-X-MAP` tags, segments of playlists which have them can't be concatenated."""
+        return [line for line in self.header if line.startswith("#EXT-X-MAP")]
+
+    def dumps(self, indices: Optional[Iterable[int]] = None, uris: Optional[Iterable[str]] = None) -> str:
+        """
+        Write the playlist back to text. When `indices` are given only those
+        segments are written, and `uris` can replace their URIs.
+        """
+        # Read twice, for the URIs and the segments
+        indices = range(len(self)) if indices is None else list(indices)
+        uris = (self.uris[i] for i in indices) if uris is None else uris
+
+        lines = list(self.header)
+        for index, uri in zip(indices, uris):
+            if self.flags[index] & DISCONTINUITY:
+                lines.append("#EXT-X-DISCONTINUITY")
+            if index in self.tags:
+                lines.extend(self.tags[index])
+            lines.append("#EXTINF:{:.3f},{}".format(self.durations[index], self.titles.get(index, "")))
+            lines.append(uri)
+        lines.extend(self.footer)
+        lines.append("")
+        return "\n".join(lines)
+
+    def dump(self, path: str, indices: Optional[Iterable[int]] = None, uris: Optional[Iterable[str]] = None):
+        with open(path, "w") as f:
+            f.write(self.dumps(indices, uris))
+
+
+def parse_media_playlist(lines: Union[str, Iterable[str]]) -> MediaPlaylist:
+    """Parse a media playlist from its text, or line by line from any iterable of lines."""
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+
+    playlist = MediaPlaylist()
+    pending: List[str] = []
+    flags = 0
+    duration = None
+    title = ""
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.startswith("#EXTINF:"):
+            duration, _, title = line[8:].partition(",")
+        elif line == "#EXT-X-DISCONTINUITY":
+            flags |= DISCONTINUITY
+        elif line.startswith("#"):
+            if not playlist.uris and line.startswith(HEADER_TAGS):
+                playlist.header.append(line)
+            else:
+                pending.append(line)
+        elif duration is not None:
+            index = len(playlist.uris)
+            playlist.uris.append(line)
+            playlist.durations.append(float(duration))
+            playlist.flags.append(flags)
+            if title:
+                playlist.titles[index] = title
+            if pending:
+                playlist.tags[index] = pending
+                pending = []
+            flags = 0
+            duration = None
+        else:
+            logger.warning(f"Ignoring playlist line without #EXTINF: {line}")
+
+    # Tags after the last segment, like #EXT-X-ENDLIST
+    playlist.footer = pending
+    return playlist
+
+
+class SegmentRange(NamedTuple):
+    uris: List[str]
+    """Unique URIs of the selected segments, in playlist order."""
+    start: float
+    """Start time of the first selected segment, or -1 if nothing is selected."""
+    end: float
+    """End time of the last selected segment, or -1 if nothing is selected."""
+    indices: List[int]
+    """Position of each selected segment in the playlist."""
+
+
+class SegmentIndex:
+    """
+    Cumulative segment durations of a media playlist, used to look up the
+    segments covering a time range in O(log n) instead of walking the
+    whole playlist.
+    """
+
+    def __init__(self, uris: Sequence[str], durations: Iterable[float]):
+        self.uris = uris
+        self.ends = array("d", accumulate(durations))
+        self.starts = array("d", [0.0])
+        self.starts.extend(self.ends[:-1])
+        if numpy is not None:
+            self._ends = numpy.frombuffer(self.ends, dtype=numpy.float64)
+            self._starts = numpy.frombuffer(self.starts, dtype=numpy.float64)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def boundaries(self, index: int) -> Tuple[float, float]:
+        """Start and end time of the segment at `index`."""
+        return self.starts[index], self.ends[index]
+
+    def find(self, start: Optional[float], end: Optional[float]) -> Tuple[int, int]:
+        """
+        Return the slice of segments overlapping [start, end). Segments
+        which are only partially covered are included, since it's better to
+        download a bit more than a bit less.
+        """
+        if numpy is not None:
+            first = int(numpy.searchsorted(self._ends, start, side="right")) if start else 0
+            last = int(numpy.searchsorted(self._starts, end, side="left")) if end else len(self)
+        else:
+            first = bisect_right(self.ends, start) if start else 0
+            last = bisect_left(self.starts, end) if end else len(self)
+        return first, max(first, last)
+
+    def select(self, start: Optional[float], end: Optional[float]) -> SegmentRange:
+        first, last = self.find(start, end)
+
+        seen = set()
+        uris = []
+        indices = []
+        for index in range(first, last):
+            uri = self.uris[index]
+            if uri not in seen:
+                seen.add(uri)
+                uris.append(uri)
+                indices.append(index)
+
+        if not indices:
+            return SegmentRange(uris, -1, -1, indices)
+
+        return SegmentRange(uris, self.starts[indices[0]], self.ends[indices[-1]], indices)
+
+
+_index_cache: "WeakKeyDictionary[MediaPlaylist, SegmentIndex]" = WeakKeyDictionary()
+
+
+def get_segment_index(playlist: MediaPlaylist) -> SegmentIndex:
+    """Return the segment index of a playlist, building it on first use."""
+    index = _index_cache.get(playlist)
+    if index is None:
+        index = SegmentIndex(playlist.uris, playlist.durations)
+        _index_cache[playlist] = index
+    return index
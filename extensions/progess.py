@@ -1,13 +1,17 @@
 ## TAKEN FROM TWITCH-DL :D
 
 
+import asyncio
+import json
 import logging
 import time
 
 from collections import deque
+from contextlib import asynccontextmanager
 from dataclasses import dataclass, field
-from statistics import mean
-from typing import Dict, NamedTuple, Optional, Deque, Callable
+from typing import Dict, List, NamedTuple, Optional, Deque, Callable
+
+from extensions.jobs import Job
 
 logger = logging.getLogger(__name__)
 
@@ -69,7 +73,8 @@ def format_time(total_seconds, force_hours=False):
 @dataclass
 class Task:
     id: TaskId
-    size: int
+    size: Optional[int]
+    """None until the task ends when the server doesn't tell the size."""
     downloaded: int = 0
 
     def advance(self, size):
@@ -81,13 +86,76 @@ class Sample(NamedTuple):
     timestamp: float
 
 
+class ProgressEvent(NamedTuple):
+    """A snapshot of the progress, sent to subscribers at a fixed interval."""
+    timestamp: float
+    vod_count: int
+    vod_downloaded_count: int
+    progress_bytes: int
+    progress_perc: int
+    estimated_total: Optional[int]
+    speed: Optional[float]
+    remaining_time: Optional[int]
+    job: Optional[str] = None
+    """Name of the job downloading, when it shares the workers with other jobs."""
+    workers: Optional[int] = None
+    """Number of requests the job has in flight."""
+
+
+Subscriber = Callable[[ProgressEvent], None]
+
+REPORT_INTERVAL = 0.1
+"""How often to send progress events to subscribers, in seconds."""
+
+
+def format_progress(event: ProgressEvent, color=True) -> str:
+    progress = " ".join(
+        [
+            f"Downloaded {event.vod_downloaded_count}/{event.vod_count} VODs",
+            f"<blue>{event.progress_perc}%</blue>",
+            f"of <blue>~{format_size(event.estimated_total)}</blue>" if event.estimated_total else "",
+            f"at <blue>{format_size(event.speed)}/s</blue>" if event.speed else "",
+            f"ETA <blue>{format_time(event.remaining_time)}</blue>" if event.remaining_time is not None else "",
+            f"on <blue>{event.workers}</blue> workers" if event.workers is not None else "",
+        ]
+    )
+    return progress if color else progress.replace("<blue>", "").replace("</blue>", "")
+
+
+def print_progress(event: ProgressEvent):
+    """Subscriber which prints progress on a single terminal line."""
+    job = f"{event.job}: " if event.job else ""
+    print(f"\r{job}{format_progress(event)}     ", end="")
+
+
+def text_subscriber(progress_txt: Callable[[str], None]) -> Subscriber:
+    """Make a subscriber which passes the progress as plain text to `progress_txt`, e.g. a GUI label."""
+    return lambda event: progress_txt(format_progress(event, color=False))
+
+
+class JsonLinesSink:
+    """Subscriber which appends every progress event as a JSON line to a file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __call__(self, event: ProgressEvent):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(event._asdict()) + "\n")
+
+
 @dataclass
 class Progress:
+    """
+    Keeps track of the download progress. Updating it is cheap, the speed
+    and ETA are only computed when a `ProgressEvent` is emitted, which
+    `report` does at a fixed interval regardless of how fast chunks arrive.
+    """
     vod_count: int
-    progress_txt: Callable
+    progress_txt: Optional[Callable[[str], None]] = None
+    job: Optional[Job] = None
     downloaded: int = 0
     estimated_total: Optional[int] = None
-    last_printed: float = field(default_factory=time.time)
     progress_bytes: int = 0
     progress_perc: int = 0
     remaining_time: Optional[int] = None
@@ -96,15 +164,28 @@ class Progress:
     tasks: Dict[TaskId, Task] = field(default_factory=dict)
     vod_downloaded_count: int = 0
     samples: Deque[Sample] = field(default_factory=lambda: deque(maxlen=100))
+    # Running totals over the sizes of started tasks, to estimate the total in O(1)
+    size_sum: int = 0
+    size_count: int = 0
+    subscribers: List[Subscriber] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.subscribe(print_progress)
+        if self.progress_txt:
+            self.subscribe(text_subscriber(self.progress_txt))
+
+    def subscribe(self, subscriber: Subscriber):
+        self.subscribers.append(subscriber)
 
-    def start(self, task_id: int, size: int):
+    def start(self, task_id: int, size: Optional[int], downloaded: int = 0):
         if task_id in self.tasks:
             raise ValueError(f"Task {task_id}: cannot start, already started")
 
-        self.tasks[task_id] = Task(task_id, size)
-        self._calculate_total()
-        self._calculate_progress()
-        self.print()
+        self.tasks[task_id] = Task(task_id, size, downloaded)
+        self.progress_bytes += downloaded
+        if size is not None:
+            self.size_sum += size
+            self.size_count += 1
 
     def advance(self, task_id: int, size: int):
         if task_id not in self.tasks:
@@ -113,9 +194,6 @@ class Progress:
         self.downloaded += size
         self.progress_bytes += size
         self.tasks[task_id].advance(size)
-        self.samples.append(Sample(self.downloaded, time.time()))
-        self._calculate_progress()
-        self.print()
 
     def already_downloaded(self, task_id: int, size: int):
         if task_id in self.tasks:
@@ -123,35 +201,81 @@ class Progress:
 
         self.tasks[task_id] = Task(task_id, size)
         self.progress_bytes += size
+        self.size_sum += size
+        self.size_count += 1
         self.vod_downloaded_count += 1
-        self._calculate_total()
-        self._calculate_progress()
-        self.print()
 
     def abort(self, task_id: int):
         if task_id not in self.tasks:
             raise ValueError(f"Task {task_id}: cannot abort, not started")
 
-        del self.tasks[task_id]
-        self.progress_bytes = sum(t.downloaded for t in self.tasks.values())
-
-        self._calculate_total()
-        self._calculate_progress()
-        self.print()
+        task = self.tasks.pop(task_id)
+        self.progress_bytes -= task.downloaded
+        if task.size is not None:
+            self.size_sum -= task.size
+            self.size_count -= 1
 
     def end(self, task_id: int):
         if task_id not in self.tasks:
             raise ValueError(f"Task {task_id}: cannot end, not started")
 
         task = self.tasks[task_id]
-        if task.size != task.downloaded:
+        if task.size is None:
+            task.size = task.downloaded
+            self.size_sum += task.size
+            self.size_count += 1
+        elif task.size != task.downloaded:
             logger.warn(f"Taks {task_id} ended with {task.downloaded}b downloaded, expected {task.size}b.")
 
         self.vod_downloaded_count += 1
-        self.print()
+
+    def emit(self):
+        """Compute the current speed and ETA and send them to all subscribers."""
+        now = time.time()
+        self.samples.append(Sample(self.downloaded, now))
+        self._calculate_total()
+        self._calculate_progress()
+        stats = self.job.stats() if self.job else None
+
+        event = ProgressEvent(
+            timestamp=now,
+            vod_count=self.vod_count,
+            vod_downloaded_count=self.vod_downloaded_count,
+            progress_bytes=self.progress_bytes,
+            progress_perc=self.progress_perc,
+            estimated_total=self.estimated_total,
+            speed=self.speed,
+            remaining_time=self.remaining_time,
+            job=stats.name if stats else None,
+            workers=stats.in_flight if stats else None,
+        )
+        for subscriber in self.subscribers:
+            try:
+                subscriber(event)
+            except Exception:
+                logger.exception("Progress subscriber failed")
+
+    async def report(self, interval: float = REPORT_INTERVAL):
+        """Emit progress events every `interval` seconds until cancelled, and a final one then."""
+        try:
+            while True:
+                self.emit()
+                await asyncio.sleep(interval)
+        finally:
+            self.emit()
+
+    @asynccontextmanager
+    async def reporting(self, interval: float = REPORT_INTERVAL):
+        """Report progress while the body of the `async with` block runs."""
+        reporter = asyncio.ensure_future(self.report(interval))
+        try:
+            yield self
+        finally:
+            reporter.cancel()
+            await asyncio.gather(reporter, return_exceptions=True)
 
     def _calculate_total(self):
-        self.estimated_total = int(mean(t.size for t in self.tasks.values()) * self.vod_count) if self.tasks else None
+        self.estimated_total = int(self.size_sum / self.size_count * self.vod_count) if self.size_count else None
 
     def _calculate_progress(self):
         self.speed = self._calculate_speed()
@@ -172,24 +296,3 @@ class Progress:
             duration = 1
 
         return size / duration
-
-    def print(self):
-        now = time.time()
-
-        # Don't print more often than 10 times per second
-        if now - self.last_printed < 0.1:
-            return
-
-        progress = " ".join(
-            [
-                f"Downloaded {self.vod_downloaded_count}/{self.vod_count} VODs",
-                f"<blue>{self.progress_perc}%</blue>",
-                f"of <blue>~{format_size(self.estimated_total)}</blue>" if self.estimated_total else "",
-                f"at <blue>{format_size(self.speed)}/s</blue>" if self.speed else "",
-                f"ETA <blue>{format_time(self.remaining_time)}</blue>" if self.remaining_time is not None else "",
-            ]
-        )
-        self.progress_txt(progress.replace("<blue>", "").replace("</blue>", ""))
-
-        print(f"\r{progress}     ", end="")
-        self.last_printed = now
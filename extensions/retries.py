@@ -0,0 +1,272 @@
+import asyncio
+import httpx
+import logging
+import random
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional, TypeVar, Union
+from urllib.parse import urlparse
+
+from extensions.integrity import IntegrityError
+from extensions.scheduler import idle
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RETRY_COUNT = 5
+"""Number of times to try a request before giving up."""
+
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+"""Response statuses which are worth retrying, other errors are final."""
+
+BACKOFF_BASE = 0.5
+"""Upper bound of the delay before the first retry, doubled for each further one."""
+
+BACKOFF_CAP = 30.0
+
+MAX_RETRY_AFTER = 120.0
+"""Longest Retry-After a server can ask for, longer ones are shortened."""
+
+BREAKER_THRESHOLD = 5
+"""Number of consecutive failures after which no more requests are sent to a host for a while."""
+
+BREAKER_COOLDOWN = 10.0
+"""Number of seconds a host is left alone before a single request probes whether it recovered."""
+
+PROBE_POLL = 0.25
+"""How often requests waiting for a probe check whether it finished."""
+
+
+def retry_after(response: Optional[httpx.Response]) -> Optional[float]:
+    """
+    Seconds the server asks to wait with a Retry-After header, given as
+    seconds or a date. Rate limited responses of Helix give the time the
+    limit resets instead, as a Unix timestamp in Ratelimit-Reset.
+    """
+    if response is None:
+        return None
+
+    value = response.headers.get("retry-after")
+    if not value and response.status_code == 429 and response.headers.get("ratelimit-reset"):
+        try:
+            seconds = float(response.headers["ratelimit-reset"]) - time.time()
+        except ValueError:
+            return None
+        return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+    if not value:
+        return None
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a request which failed with `error` may succeed when tried again."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRY_STATUSES
+    return isinstance(error, (httpx.TransportError, IntegrityError))
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: the delay before retry n is
+    random between 0 and `base` * 2^n, capped at `cap`. Spreading the
+    retries out keeps workers which failed together from all hitting the
+    server again at the same moment. A Retry-After header is honored when
+    it asks for longer.
+    """
+
+    def __init__(self, attempts: int = RETRY_COUNT, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP):
+        self.attempts: int = attempts
+        self.base: float = base
+        self.cap: float = cap
+
+    def backoff(self, n: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2 ** n))
+
+    def delay(self, n: int, error: BaseException) -> float:
+        response = error.response if isinstance(error, httpx.HTTPStatusError) else None
+        return max(self.backoff(n), retry_after(response) or 0.0)
+
+
+class CircuitBreaker:
+    """
+    Stop sending requests to a host which keeps failing. After `threshold`
+    consecutive failures the circuit opens and requests wait for `cooldown`
+    seconds. Then a single request is let through as a probe, if it
+    succeeds the circuit closes again, if not it opens for another cooldown.
+
+    A Retry-After from the host pauses all requests to it, not just the
+    one which got it. Used from any thread.
+    """
+
+    def __init__(self, host: str, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.host: str = host
+        self.threshold: int = threshold
+        self.cooldown: float = cooldown
+        self.failures: int = 0
+        self.opened: int = 0
+        """Number of times the circuit opened."""
+
+        self._closed_at: float = 0.0
+        self._probing: bool = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def wait_time(self) -> float:
+        """
+        Seconds to wait before a request may be sent. When it returns 0 for
+        a probe, the caller must report the outcome with `success`,
+        `failure` or `release`.
+        """
+        with self._lock:
+            remaining = self._closed_at - time.monotonic()
+            if remaining > 0:
+                return remaining
+            if not self.is_open:
+                return 0.0
+            if self._probing:
+                return PROBE_POLL
+            self._probing = True
+            return 0.0
+
+    def success(self):
+        with self._lock:
+            if self.is_open:
+                logger.info(f"{self.host}: recovered, closing circuit")
+            self.failures = 0
+            self._probing = False
+
+    def failure(self, pause: Optional[float] = None):
+        with self._lock:
+            probe = self._probing
+            self.failures += 1
+            self._probing = False
+            if self.failures == self.threshold or (self.is_open and probe):
+                self.opened += 1
+                logger.warning(f"{self.host}: {self.failures} failures in a row, pausing requests for {self.cooldown:.0f}s")
+                pause = max(pause or 0.0, self.cooldown)
+            if pause:
+                self._closed_at = max(self._closed_at, time.monotonic() + pause)
+
+    def release(self):
+        """Give up a probe without an outcome, like when its request was cancelled."""
+        with self._lock:
+            self._probing = False
+
+    def wait_sync(self):
+        while (delay := self.wait_time()) > 0:
+            time.sleep(delay)
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(url: str) -> CircuitBreaker:
+    """The circuit breaker of the host of `url`, shared by all downloads."""
+    host = urlparse(url).netloc
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def _record(breaker: CircuitBreaker, error: BaseException):
+    if not is_retryable(error):
+        # The host answered, it's the request which is wrong
+        breaker.success()
+    elif isinstance(error, httpx.HTTPStatusError):
+        breaker.failure(retry_after(error.response))
+    else:
+        breaker.failure()
+
+
+AnyURL = Union[str, Callable[[], str]]
+"""A URL, or a function which picks the URL for each try."""
+
+
+def _pick(url: AnyURL) -> str:
+    return url() if callable(url) else url
+
+
+async def retry_async(
+    url: AnyURL,
+    attempt: Callable[[str], Awaitable[T]],
+    on_error: Optional[Callable[[BaseException, int, float], None]] = None,
+    policy: Optional[RetryPolicy] = None,
+) -> T:
+    """
+    Call `attempt(url)` until it succeeds, backing off between tries as
+    given by `policy`. Errors which can't be fixed by retrying are raised
+    right away. `on_error(error, n, delay)` is called before each retry.
+
+    Within `run_in_order`, the slot of the worker is given up while
+    waiting for the host or to retry.
+    """
+    policy = policy or RetryPolicy()
+    for n in range(policy.attempts):
+        source = _pick(url)
+        breaker = get_breaker(source)
+        # Checked with the slot held, so a probe is taken right before it's sent
+        while (delay := breaker.wait_time()) > 0:
+            async with idle():
+                await asyncio.sleep(delay)
+        try:
+            result = await attempt(source)
+        except Exception as e:
+            _record(breaker, e)
+            if not is_retryable(e) or n + 1 >= policy.attempts:
+                raise
+            delay = policy.delay(n, e)
+            if on_error is not None:
+                on_error(e, n, delay)
+            async with idle():
+                await asyncio.sleep(delay)
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            breaker.success()
+            return result
+
+    raise Exception("Should not happen")
+
+
+def retry_sync(url: AnyURL, attempt: Callable[[str], T], policy: Optional[RetryPolicy] = None) -> T:
+    """Like `retry_async`, for blocking requests."""
+    policy = policy or RetryPolicy()
+    for n in range(policy.attempts):
+        source = _pick(url)
+        breaker = get_breaker(source)
+        breaker.wait_sync()
+        try:
+            result = attempt(source)
+        except Exception as e:
+            _record(breaker, e)
+            if not is_retryable(e) or n + 1 >= policy.attempts:
+                raise
+            delay = policy.delay(n, e)
+            logger.warning(f"{source} failed: {e}. Retrying in {delay:.1f}s")
+            time.sleep(delay)
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            breaker.success()
+            return result
+
+    raise Exception("Should not happen")
@@ -0,0 +1,221 @@
+import asyncio
+import heapq
+import logging
+
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+from extensions.concurrency import AnyConcurrency
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentQueue:
+    """Hand out segment indices lowest first, so the completed prefix grows as fast as possible."""
+
+    def __init__(self, indices: Iterable[int]):
+        self._heap: List[int] = list(indices)
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def pop(self) -> Optional[int]:
+        return heapq.heappop(self._heap) if self._heap else None
+
+    def push(self, index: int):
+        heapq.heappush(self._heap, index)
+
+
+class Watermark:
+    """
+    Track completed segments and how many of the first segments are
+    complete without gaps, so work on the finished prefix can start while
+    the rest is still downloading.
+    """
+
+    def __init__(self, count: int):
+        self.count: int = count
+        self.prefix: int = 0
+        """Number of segments from the start of the playlist which are complete."""
+
+        self._done: Set[int] = set()
+        self._callbacks: List[Callable[[int], None]] = []
+        self._segment_callbacks: List[Callable[[int], None]] = []
+        self._condition = asyncio.Condition()
+
+    def subscribe(self, callback: Callable[[int], None]):
+        """Call `callback` with the new prefix every time it grows."""
+        self._callbacks.append(callback)
+
+    def subscribe_segments(self, callback: Callable[[int], None]):
+        """Call `callback` with the index of every segment as it completes."""
+        self._segment_callbacks.append(callback)
+
+    async def complete(self, index: int):
+        for callback in self._segment_callbacks:
+            callback(index)
+
+        self._done.add(index)
+        if index != self.prefix:
+            return
+
+        while self.prefix in self._done:
+            self._done.remove(self.prefix)
+            self.prefix += 1
+
+        for callback in self._callbacks:
+            callback(self.prefix)
+
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def wait_for(self, prefix: int):
+        """Wait until at least the first `prefix` segments are complete."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.prefix >= min(prefix, self.count))
+
+
+class Slot:
+    """
+    A slot of the concurrency limit, held by a worker of `run_in_order`
+    while it fetches a segment. The slot is given up while the fetch only
+    waits, see `idle`.
+    """
+
+    def __init__(self, concurrency: AnyConcurrency):
+        self.concurrency = concurrency
+        self.held: bool = False
+        self.charge: float = 0.0
+        """Bytes a job was charged for the slot when it was given out, see `Job`."""
+        self.transferred: int = 0
+        """Bytes downloaded while the slot was held."""
+
+    async def acquire(self):
+        await self.concurrency.__aenter__()
+        self.held = True
+
+    async def release(self):
+        if self.held:
+            self.held = False
+            await self.concurrency.__aexit__(None, None, None)
+
+
+_slot: ContextVar[Optional[Slot]] = ContextVar("slot", default=None)
+
+
+def current_slot() -> Optional[Slot]:
+    """The slot of the worker running the current task, if any."""
+    return _slot.get()
+
+
+@asynccontextmanager
+async def idle() -> AsyncIterator[None]:
+    """
+    Give up the slot of the current worker in the block, and take it
+    again after. Used while waiting, like before a retry, so requests to
+    other hosts or of other jobs can go meanwhile.
+    """
+    slot = _slot.get()
+    if slot is None or not slot.held:
+        yield
+        return
+
+    await slot.release()
+    try:
+        yield
+    finally:
+        await slot.acquire()
+
+
+async def detached(awaitable: Awaitable):
+    """Run `awaitable` as a task of its own, without the slot of the worker which started it."""
+    _slot.set(None)
+    return await awaitable
+
+
+async def cancel_all(tasks: Iterable[asyncio.Future]):
+    """Cancel `tasks` and wait until they have stopped."""
+    tasks = list(tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def gather_or_cancel(*awaitables: Awaitable) -> list:
+    """
+    Like `asyncio.gather`, but when one fails or the caller is cancelled
+    the others are cancelled as well, and are done before it raises.
+    """
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        await cancel_all(tasks)
+        raise
+
+
+async def run_in_order(
+    count: int,
+    concurrency: AnyConcurrency,
+    fetch: Callable[[int], Awaitable],
+    watermark: Optional[Watermark] = None,
+    failed: Optional[Dict[int, Exception]] = None,
+):
+    """
+    Call `fetch` for every segment index in `range(count)`, within the
+    concurrency limit. Whenever a slot frees up, it is given to the lowest
+    index which is not started yet.
+
+    `fetch` may return an awaitable for work which should not hold up the
+    slot, like writing the rest of the segment to disk.
+
+    When one segment fails, all other work is cancelled and has stopped
+    before the error is raised. With a `failed` dict, the error of a
+    segment is recorded there instead while the others continue, and the
+    segment is never completed in the `watermark`.
+    """
+    queue = SegmentQueue(range(count))
+    watermark = watermark or Watermark(count)
+    finishing: List[asyncio.Future] = []
+
+    def fail(index: int, error: Exception):
+        if failed is None:
+            raise error
+        logger.warning(f"Task {index} failed: {error}")
+        failed[index] = error
+
+    async def finish(index: int, pending: Optional[Awaitable]):
+        if pending is not None:
+            try:
+                await pending
+            except Exception as e:
+                fail(index, e)
+                return
+        await watermark.complete(index)
+
+    async def worker():
+        slot = Slot(concurrency)
+        _slot.set(slot)
+        while True:
+            await slot.acquire()
+            try:
+                index = queue.pop()
+                if index is None:
+                    return
+                try:
+                    pending = await fetch(index)
+                except Exception as e:
+                    fail(index, e)
+                    continue
+            finally:
+                await slot.release()
+            finishing.append(asyncio.ensure_future(detached(finish(index, pending))))
+
+    try:
+        await gather_or_cancel(*(worker() for _ in range(min(concurrency.maximum, count))))
+        await asyncio.gather(*finishing)
+    except BaseException:
+        await cancel_all(finishing)
+        raise
@@ -0,0 +1,150 @@
+import asyncio
+import httpx
+import logging
+import os
+
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+from extensions.concurrency import AdaptiveConcurrency, AnyConcurrency, FixedConcurrency
+from extensions.clients import get_async_client
+from extensions.jobs import Job
+from extensions.http import (
+    AnyTokenBucket,
+    EndlessTokenBucket,
+    TokenBucket,
+    download_to_memory,
+    log_concurrency,
+    retry,
+)
+from extensions.progess import Progress, Subscriber
+from extensions.scheduler import gather_or_cancel, run_in_order
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+STREAM_WINDOW = 256 * MB
+"""How many bytes of out of order segments to keep in memory before spilling them to disk."""
+
+
+def _write_file(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        data = f.read()
+    os.remove(path)
+    return data
+
+
+class ReassemblyBuffer:
+    """
+    Collect segments which complete in any order and hand them over in
+    playlist order. Segments which arrive ahead of their turn are kept in
+    memory up to `window` bytes, further ones are spilled to `spill_dir`.
+    """
+
+    def __init__(self, count: int, window: int, spill_dir: str):
+        self.count: int = count
+        self.window: int = window
+        self.spill_dir: str = spill_dir
+        self.next: int = 0
+        self.buffered: int = 0
+        self.spilled: int = 0
+        self._segments: Dict[int, Union[bytearray, str]] = {}
+        self._condition = asyncio.Condition()
+
+    async def put(self, index: int, data: bytearray):
+        if index != self.next and self.buffered + len(data) > self.window:
+            path = os.path.join(self.spill_dir, "{:05d}.ts".format(index))
+            await asyncio.to_thread(_write_file, path, data)
+            self.spilled += 1
+            segment = path
+        else:
+            self.buffered += len(data)
+            segment = data
+
+        async with self._condition:
+            self._segments[index] = segment
+            self._condition.notify_all()
+
+    async def drain(self, writer: asyncio.StreamWriter):
+        """Write all segments to `writer` in order, waiting for missing ones."""
+        while self.next < self.count:
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.next in self._segments)
+                segment = self._segments.pop(self.next)
+
+            if isinstance(segment, str):
+                data = await asyncio.to_thread(_read_file, segment)
+            else:
+                data = segment
+                self.buffered -= len(data)
+
+            writer.write(data)
+            await writer.drain()
+            self.next += 1
+
+
+async def stream_with_retries(
+    client: httpx.AsyncClient,
+    concurrency: AnyConcurrency,
+    task_id: int,
+    source: str,
+    buffer: ReassemblyBuffer,
+    progress: Progress,
+    token_bucket: AnyTokenBucket,
+):
+    data = await retry(task_id, source, progress, concurrency, lambda url: download_to_memory(
+        client, task_id, url, progress, token_bucket, concurrency))
+    await buffer.put(task_id, data)
+
+
+async def stream_all(
+    progresstxt: Callable,
+    sources: List[str],
+    command: List[str],
+    spill_dir: str,
+    workers: Optional[int] = None,
+    *,
+    rate_limit: Optional[int] = None,
+    window: int = STREAM_WINDOW,
+    subscribers: Sequence[Subscriber] = (),
+    job: Optional[Job] = None,
+) -> int:
+    """
+    Download all sources and pipe them in order into the stdin of `command`
+    while later sources are still downloading. Returns the exit code of
+    the command. Pass a `job` to share the workers of the `JobScheduler`.
+    """
+    progress = Progress(len(sources), progress_txt=progresstxt, job=job)
+    for subscriber in subscribers:
+        progress.subscribe(subscriber)
+    token_bucket = TokenBucket(rate_limit) if rate_limit else EndlessTokenBucket()
+    concurrency = job or (FixedConcurrency(workers) if workers else AdaptiveConcurrency())
+    buffer = ReassemblyBuffer(len(sources), window, spill_dir)
+
+    process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE)
+    try:
+        client = get_async_client()
+        async with progress.reporting():
+            async def fetch(task_id: int):
+                await stream_with_retries(
+                    client, concurrency, task_id, sources[task_id], buffer, progress, token_bucket)
+
+            await gather_or_cancel(buffer.drain(process.stdin), run_in_order(len(sources), concurrency, fetch))
+
+        process.stdin.close()
+        await process.stdin.wait_closed()
+    except BaseException:
+        process.kill()
+        await process.wait()
+        raise
+
+    log_concurrency(concurrency)
+    if buffer.spilled:
+        logger.info(f"{buffer.spilled} segments were spilled to disk")
+
+    return await process.wait()
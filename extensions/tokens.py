@@ -0,0 +1,75 @@
+import json
+import logging
+import threading
+import time
+
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+REFRESH_AHEAD = 5 * 60
+"""Fetch a new token when the cached one expires within this many seconds."""
+
+DEFAULT_LIFETIME = 10 * 60
+"""How long to keep tokens whose expiry can't be read."""
+
+
+def token_expiry(access_token: Optional[Dict[str, Any]]) -> Optional[float]:
+    """
+    Return when an access token expires. The token `value` is a JSON
+    document with an `expires` unix timestamp.
+    """
+    try:
+        return float(json.loads(access_token["value"])["expires"])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+
+class TokenCache:
+    """
+    Keep access tokens until shortly before they expire, so queuing the
+    same video several times only asks for a token once. Tokens are looked
+    up by key with `fetch(key)`, and `get_token` finds the token in the
+    response when it's nested.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[Hashable], Any],
+        get_token: Callable[[Any], Optional[Dict[str, Any]]] = lambda response: response,
+        refresh_ahead: float = REFRESH_AHEAD,
+    ):
+        self.fetch = fetch
+        self.get_token = get_token
+        self.refresh_ahead: float = refresh_ahead
+        self._tokens: Dict[Hashable, Tuple[Any, float]] = {}
+        self._lock = threading.Lock()
+
+    def _expires(self, response: Any) -> float:
+        expires = token_expiry(self.get_token(response))
+        if expires is None:
+            return time.time() + DEFAULT_LIFETIME
+        return expires
+
+    def cached(self, key: Hashable) -> Optional[Any]:
+        """Return the token if it's valid for longer than `refresh_ahead`, otherwise None."""
+        with self._lock:
+            response, expires = self._tokens.get(key, (None, 0))
+        if expires - time.time() > self.refresh_ahead:
+            return response
+        return None
+
+    def put(self, key: Hashable, response: Any):
+        if response:
+            with self._lock:
+                self._tokens[key] = (response, self._expires(response))
+
+    def get(self, key: Hashable, refresh: bool = False) -> Any:
+        """Return a valid token, fetching a new one when it's about to expire or `refresh` is set."""
+        response = None if refresh else self.cached(key)
+        if response is None:
+            logger.info("Fetching access token")
+            response = self.fetch(key)
+            self.put(key, response)
+        return response
+
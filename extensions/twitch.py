@@ -1,5 +1,6 @@
-import requests
+import asyncio
 import datetime
+import json
 import httpx
 from typing import Dict
 import m3u8
@@ -7,11 +8,22 @@ from pathlib import Path
 from urllib.parse import urlparse, urlencode
 import os
 from typing import List, Optional, OrderedDict
+from extensions.buffers import BUFFER_SIZE
+from extensions.cache import cache_key, cached_get, get_cache
+from extensions.clients import get_async_client, get_client
+from extensions import loop as background
+from extensions.http import ResumeFailed, range_headers, resume_offset
+from extensions.jobs import run_job
+from extensions.playlist import MediaPlaylist, SegmentRange, get_segment_index
 from extensions.progess import Progress
+from extensions.retries import RetryPolicy, retry_async, retry_sync
+from extensions.scheduler import gather_or_cancel
+from extensions.stream import stream_all
+from extensions.tokens import TokenCache
 import subprocess
 import re
 import unicodedata
-from datetime import date, timedelta
+from datetime import timedelta
 
 CLIENT_ID = "kd1unb4b3q4t58fwlpcbzcbnm76a8fp"
 
@@ -76,6 +88,10 @@ def _video_target_filename(video, args, start_sec, end_sec):
         raise ConsoleError("Invalid key {} used in --output. Supported keys are: {}".format(e, supported))
 
 
+def _clip_slug(clip_url):
+    return clip_url.replace("https://clips.twitch.tv/", "")
+
+
 def _clip_target_filename(clip, args):
     date, time = clip["createdAt"].split("T")
     game = clip["game"]["name"] if clip["game"] else "Unknown"
@@ -106,30 +122,45 @@ def _clip_target_filename(clip, args):
         raise ConsoleError("Invalid key {} used in --output. Supported keys are: {}".format(e, supported))
 
 
-def get_clip_access_token(slug):
-    query = """
-    {{
+def _clip_access_token_operation(slug):
+    return {
         "operationName": "VideoAccessToken_Clip",
-        "variables": {{
-            "slug": "{slug}"
-        }},
-        "extensions": {{
-            "persistedQuery": {{
+        "variables": {"slug": slug},
+        "extensions": {
+            "persistedQuery": {
                 "version": 1,
-                "sha256Hash": "36b89d2507fce29e5ca551df756d27c1cfe079e2609642b4390aa4c35796eb11"
-            }}
-        }}
-    }}
-    """
+                "sha256Hash": "36b89d2507fce29e5ca551df756d27c1cfe079e2609642b4390aa4c35796eb11",
+            }
+        },
+    }
+
 
-    response = gql_post(query.format(slug=slug).strip())
+def get_clip_access_token(slug):
+    response = gql_post(json.dumps(_clip_access_token_operation(slug)))
     return response["data"]["clip"]
 
 
+def get_clip_access_tokens(slugs):
+    """Batched `get_clip_access_token`, returns a dict from slug to access token or the exception."""
+    tokens = {slug: clip_tokens.cached(slug) for slug in slugs}
+    missing = [slug for slug, token in tokens.items() if token is None]
+    if missing:
+        results = gql_batch([_clip_access_token_operation(slug) for slug in missing])
+        for slug, token in _results_by_key(missing, results, "clip").items():
+            tokens[slug] = token
+            if not isinstance(token, Exception):
+                clip_tokens.put(slug, token)
+    return tokens
+
+
+clip_tokens = TokenCache(get_clip_access_token, lambda clip: clip["playbackAccessToken"])
+"""Clip access tokens by slug."""
+
+
 def authenticated_post(url, data=None, json=None, headers={}):
     headers["Client-ID"] = CLIENT_ID
 
-    response = httpx.post(url, data=data, json=json, headers=headers)
+    response = get_client().post(url, data=data, json=json, headers=headers)
     if response.status_code == 400:
         data = response.json()
         raise ConsoleError(data["message"])
@@ -163,7 +194,7 @@ CLIP_FIELDS = """
 """
 
 
-def get_clip(slug):
+def _clip_query(slug):
     query = """
     {{
         clip(slug: "{}") {{
@@ -172,8 +203,25 @@ def get_clip(slug):
     }}
     """
 
-    response = gql_query(query.format(slug, fields=CLIP_FIELDS))
-    return response["data"]["clip"]
+    return query.format(slug, fields=CLIP_FIELDS)
+
+
+def get_clip(slug):
+    return get_cache().cached("clip", slug, lambda: gql_query(_clip_query(slug))["data"]["clip"])
+
+
+def get_clips(slugs):
+    """Batched `get_clip`, returns a dict from slug to clip or the exception."""
+    cache = get_cache()
+    clips = {slug: cache.get("clip", slug) for slug in slugs}
+    missing = [slug for slug, clip in clips.items() if clip is None]
+    if missing:
+        results = gql_batch([{"query": _clip_query(slug)} for slug in missing])
+        for slug, clip in _results_by_key(missing, results, "clip").items():
+            clips[slug] = clip
+            if clip and not isinstance(clip, Exception):
+                cache.put("clip", slug, clip)
+    return clips
 
 
 def gql_post(query):
@@ -186,7 +234,41 @@ def gql_post(query):
     return response
 
 
-CHUNK_SIZE = 1024
+GQL_BATCH_SIZE = 35
+"""Maximum number of operations to send in a single GraphQL request."""
+
+
+def gql_batch(operations, headers: Dict[str, str] = {}, batch_size: int = GQL_BATCH_SIZE):
+    """
+    Run many GraphQL operations with as few requests as possible. Returns
+    the response of each operation in order, or the exception if it failed,
+    so one failing operation doesn't fail the whole batch.
+    """
+    url = "https://gql.twitch.tv/gql"
+    results = []
+    for i in range(0, len(operations), batch_size):
+        batch = operations[i : i + batch_size]
+        try:
+            responses = authenticated_post(url, json=batch, headers=dict(headers)).json()
+        except (httpx.HTTPError, ConsoleError) as e:
+            results.extend([e] * len(batch))
+            continue
+
+        if not isinstance(responses, list) or len(responses) != len(batch):
+            results.extend([GQLError([responses])] * len(batch))
+            continue
+
+        for response in responses:
+            results.append(GQLError(response["errors"]) if "errors" in response else response)
+
+    return results
+
+
+def _results_by_key(keys, results, field):
+    return {key: result if isinstance(result, Exception) else result["data"][field] for key, result in zip(keys, results)}
+
+
+CHUNK_SIZE = BUFFER_SIZE
 CONNECT_TIMEOUT = 5
 RETRY_COUNT = 5
 
@@ -197,9 +279,18 @@ class DownloadFailed(Exception):
 
 def _download(url: str, path: str):
     tmp_path = path + ".tmp"
-    size = 0
-    with httpx.stream("GET", url, timeout=CONNECT_TIMEOUT) as response:
-        with open(tmp_path, "wb") as target:
+    offset, headers = range_headers(tmp_path)
+    with get_client().stream("GET", url, headers=headers, timeout=CONNECT_TIMEOUT) as response:
+        if response.status_code != 416:
+            response.raise_for_status()
+        try:
+            offset = resume_offset(response, offset)
+        except ResumeFailed:
+            os.remove(tmp_path)
+            return _download(url, path)
+
+        size = offset
+        with open(tmp_path, "ab" if offset else "wb") as target:
             for chunk in response.iter_bytes(chunk_size=CHUNK_SIZE):
                 target.write(chunk)
                 size += len(chunk)
@@ -214,13 +305,10 @@ def download_file(url: str, path_o: str, retries: int = RETRY_COUNT):
         return (os.path.getsize(path_o), from_disk)
 
     from_disk = False
-    for _ in range(retries):
-        try:
-            return (_download(url, path_o), from_disk)
-        except httpx.RequestError:
-            pass
-
-    raise DownloadFailed(":(")
+    try:
+        return (retry_sync(url, lambda url: _download(url, path_o), RetryPolicy(retries)), from_disk)
+    except httpx.HTTPError as e:
+        raise DownloadFailed(":(") from e
 
 
 def _get_clip_url(clip, quality):
@@ -241,9 +329,9 @@ def _get_clip_url(clip, quality):
         raise ConsoleError(msg)
 
 
-def get_clip_authenticated_url(slug, quality):
-    print("<dim>Fetching access token...</dim>")
-    access_token = get_clip_access_token(slug)
+def get_clip_authenticated_url(slug, quality, access_token=None):
+    if access_token is None:
+        access_token = clip_tokens.get(slug)
 
     if not access_token:
         raise ConsoleError("Access token not found for slug '{}'".format(slug))
@@ -260,11 +348,10 @@ def get_clip_authenticated_url(slug, quality):
     return "{}?{}".format(url, query)
 
 
-def _join_vods(playlist_path, target, overwrite, video, start):
+def _join_command(input_args, target, overwrite, video, start):
     command = [
         "ffmpeg",
-        "-i",
-        playlist_path,
+        *input_args,
         "-c",
         "copy",
         "-metadata",
@@ -285,46 +372,48 @@ def _join_vods(playlist_path, target, overwrite, video, start):
     if overwrite:
         command.append("-y")
 
+    return command
+
+
+def _join_vods(playlist_path, target, overwrite, video, start):
+    command = _join_command(["-i", playlist_path], target, overwrite, video, start)
+
     print("<dim>{}</dim>".format(" ".join(command)))
     result = subprocess.run(command)
     if result.returncode != 0:
         raise ConsoleError("Joining files failed")
 
 
-def _get_vod_paths(playlist, start: Optional[int], end: Optional[int]):
-    """Extract unique VOD paths for download from playlist."""
-    files = []
-    vod_start = 0
-    startstart = -1
-    endend  = -1
-    for segment in playlist.segments:
-        vod_end = vod_start + segment.duration
+def _stream_vods(progresstxt, sources, spill_dir, target, overwrite, video, start, subscribers=()):
+    """Join segments by piping them into ffmpeg while they are downloading."""
+    command = _join_command(["-f", "mpegts", "-i", "pipe:0"], target, overwrite, video, start)
+
+    print("<dim>{}</dim>".format(" ".join(command)))
+    returncode = background.run(run_job("VOD {}".format(video["id"]), lambda job: stream_all(
+        progresstxt, sources, command, spill_dir, subscribers=subscribers, job=job)))
+    if returncode != 0:
+        raise ConsoleError("Joining files failed")
 
-        # `vod_end > start` is used here becuase it's better to download a bit
-        # more than a bit less, similar for the end condition
-        start_condition = not start or vod_end > start
-        end_condition = not end or vod_start < end
 
-        if start_condition and end_condition and segment.uri not in files:
-            files.append(segment.uri)
-            if startstart == -1:
-                startstart = vod_start
-            endend = vod_end
+def _get_vod_paths(playlist: MediaPlaylist, start: Optional[int], end: Optional[int]) -> SegmentRange:
+    """Extract unique VOD paths for download from playlist."""
+    return get_segment_index(playlist).select(start, end)
 
-        vod_start = vod_end
 
-    return [files, startstart, endend]
+def _temp_job_dir(root_output, job: str) -> str:
+    """The temp dir of one download job, which holds nothing of other jobs."""
+    return str(Path(root_output, "twitch-dl", job))
 
 
-def _crete_temp_dir(base_uri: str, root_output) -> str:
-    """Create a temp dir to store downloads if it doesn't exist."""
+def _crete_temp_dir(base_uri: str, root_output, job: str) -> str:
+    """Create a temp dir to store the downloads of `job` if it doesn't exist."""
     path = urlparse(base_uri).path.lstrip("/")
-    temp_dir = Path(root_output, "twitch-dl", path)
+    temp_dir = Path(_temp_job_dir(root_output, job), path)
     temp_dir.mkdir(parents=True, exist_ok=True)
     return str(temp_dir)
 
 
-def get_access_token(video_id, auth_token=None):
+def _access_token_query(video_id):
     query = """
     {{
         videoPlaybackAccessToken(
@@ -341,14 +430,19 @@ def get_access_token(video_id, auth_token=None):
     }}
     """
 
-    query = query.format(video_id=video_id)
+    return query.format(video_id=video_id)
+
 
+def _auth_headers(auth_token):
     headers = {}
     if auth_token is not None:
         headers["authorization"] = f"Bearer {auth_token}"
+    return headers
 
+
+def get_access_token(video_id, auth_token=None):
     try:
-        response = gql_query(query, headers=headers)
+        response = gql_query(_access_token_query(video_id), headers=_auth_headers(auth_token))
         return response["data"]["videoPlaybackAccessToken"]
     except httpx.HTTPStatusError as error:
         # Provide a more useful error message when server returns HTTP 401
@@ -362,6 +456,32 @@ def get_access_token(video_id, auth_token=None):
         raise
 
 
+vod_tokens = TokenCache(lambda key: get_access_token(*key))
+"""VOD access tokens by video id and auth token."""
+
+
+def get_cached_access_token(video_id, auth_token=None, refresh=False):
+    """Like `get_access_token`, but reuses the token until shortly before it expires."""
+    return vod_tokens.get((video_id, auth_token), refresh)
+
+
+def get_access_tokens(video_ids, auth_token=None):
+    """
+    Batched `get_cached_access_token`, returns a dict from video id to
+    access token or the exception. The tokens are cached for the downloads.
+    """
+    tokens = {video_id: vod_tokens.cached((video_id, auth_token)) for video_id in video_ids}
+    missing = [video_id for video_id, token in tokens.items() if token is None]
+    if missing:
+        operations = [{"query": _access_token_query(video_id)} for video_id in missing]
+        results = gql_batch(operations, headers=_auth_headers(auth_token))
+        for video_id, token in _results_by_key(missing, results, "videoPlaybackAccessToken").items():
+            tokens[video_id] = token
+            if not isinstance(token, Exception):
+                vod_tokens.put((video_id, auth_token), token)
+    return tokens
+
+
 def _get_playlist_by_name(playlists, quality):
     if quality == "source":
         _, _, uri = playlists[0]
@@ -376,6 +496,16 @@ def _get_playlist_by_name(playlists, quality):
     raise ConsoleError(msg)
 
 
+def _get_playlist_bases(playlists, uri):
+    """
+    Base URIs serving the segments of the media playlist `uri`: its own,
+    then the same path on the other hosts of the master playlist.
+    """
+    base = urlparse(re.sub("/[^/]+$", "/", uri))
+    hosts = dict.fromkeys([base.netloc] + [urlparse(u).netloc for _, _, u in playlists])
+    return [base._replace(netloc=host).geturl() for host in hosts]
+
+
 def _parse_playlists(playlists_m3u8):
     playlists = m3u8.loads(playlists_m3u8)
 
@@ -390,13 +520,19 @@ def _parse_playlists(playlists_m3u8):
         yield name, description, p.uri
 
 
-def get_playlists(video_id, access_token):
+def get_playlists(video_id, access_token, refresh=False):
     """
     For a given video return a playlist which contains possible video qualities.
+    Pass `refresh` to skip the cache, like after the access token expired.
     """
     url = "http://usher.ttvnw.net/vod/{}".format(video_id)
+    if refresh:
+        get_cache().invalidate("playlists", str(video_id))
 
-    response = httpx.get(
+    return cached_get(
+        get_client(),
+        "playlists",
+        str(video_id),
         url,
         params={
             "nauth": access_token["value"],
@@ -406,11 +542,9 @@ def get_playlists(video_id, access_token):
             "player": "twitchweb",
         },
     )
-    response.raise_for_status()
-    return response.content.decode("utf-8")
 
 
-def get_channel_videos(channel_id, limit, sort, type="archive", game_ids=[], after=None):
+def _channel_videos_query(channel_id, limit, sort, type, game_ids, after):
     query = """
     {{
         user(login: "{channel_id}") {{
@@ -438,16 +572,61 @@ def get_channel_videos(channel_id, limit, sort, type="archive", game_ids=[], aft
     }}
     """
 
-    query = query.format(channel_id=channel_id, game_ids=game_ids, after=after if after else "", limit=limit, sort=sort.upper(), type=type.upper(), fields=VIDEO_FIELDS)
+    return query.format(channel_id=channel_id, game_ids=game_ids, after=after if after else "", limit=limit, sort=sort.upper(), type=type.upper(), fields=VIDEO_FIELDS)
 
-    response = gql_query(query)
 
+def _channel_videos(channel_id, response):
     if not response["data"]["user"]:
         raise ConsoleError("Channel {} not found".format(channel_id))
 
     return response["data"]["user"]["videos"]
 
 
+def get_channel_videos(channel_id, limit, sort, type="archive", game_ids=[], after=None):
+    query = _channel_videos_query(channel_id, limit, sort, type, game_ids, after)
+    key = cache_key(query)
+    videos = get_cache().get("videos", key)
+    if videos is None:
+        videos = _channel_videos(channel_id, gql_query(query))
+        get_cache().put("videos", key, videos)
+    return videos
+
+
+async def get_channel_videos_async(channel_id, limit, sort, type="archive", game_ids=[], after=None):
+    query = _channel_videos_query(channel_id, limit, sort, type, game_ids, after)
+    key = cache_key(query)
+    videos = get_cache().get("videos", key)
+    if videos is None:
+        videos = _channel_videos(channel_id, await gql_query_async(query))
+        get_cache().put("videos", key, videos)
+    return videos
+
+
+async def iter_channel_videos(channel_id, sort, type="archive", game_ids=[], page_size=100):
+    """
+    Yield all videos of a channel, following the page cursors. The next
+    page is requested while the current one is being consumed, so the
+    caller can start working on the first videos right away.
+    """
+    def fetch(after):
+        return asyncio.ensure_future(get_channel_videos_async(channel_id, page_size, sort, type, game_ids, after))
+
+    next_page = fetch(None)
+    try:
+        while next_page is not None:
+            videos = await next_page
+            edges = videos["edges"]
+            next_page = None
+            if videos["pageInfo"]["hasNextPage"] and edges:
+                next_page = fetch(edges[-1]["cursor"])
+
+            for edge in edges:
+                yield edge["node"]
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
 class ConsoleError(Exception):
     """Raised when an error occurs and script exectuion should halt."""
 
@@ -465,10 +644,25 @@ def gql_query(query: str, headers: Dict[str, str] = {}):
     return response
 
 
+async def gql_query_async(query: str, headers: Dict[str, str] = {}):
+    url = "https://gql.twitch.tv/gql"
+    response = await get_async_client().post(url, json={"query": query}, headers={**headers, "Client-ID": CLIENT_ID})
+    if response.status_code == 400:
+        raise ConsoleError(response.json()["message"])
+
+    response.raise_for_status()
+    response = response.json()
+
+    if "errors" in response:
+        raise GQLError(response["errors"])
+
+    return response
+
+
 def authenticated_post(url, data=None, json=None, headers={}):
     headers["Client-ID"] = CLIENT_ID
 
-    response = httpx.post(url, data=data, json=json, headers=headers)
+    response = get_client().post(url, data=data, json=json, headers=headers)
     if response.status_code == 400:
         data = response.json()
         raise ConsoleError(data["message"])
@@ -478,45 +672,81 @@ def authenticated_post(url, data=None, json=None, headers={}):
     return response
 
 
+CLIP_WINDOW_WORKERS = 8
+"""How many time windows of clips to request at the same time."""
+
+MIN_CLIP_WINDOW = timedelta(minutes=1)
+"""Windows which still return a full page below this length are paginated instead of split."""
+
+
+def _helix_time(time):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+async def get_clips_filtered_async(channel_id, after, before, client_id, access_token, limit=100, workers=CLIP_WINDOW_WORKERS):
+    """
+    Fetch all clips created between the days `after` and `before`. Helix
+    only paginates so deep into one query, so the range is fetched as
+    windows in parallel, and a window which returns a full page is split
+    in half until every window fits in a page. Returns the clips ordered
+    by views like Helix does.
+    """
+    client = get_async_client()
+    headers = {"Client-ID": client_id, "Authorization": "Bearer " + access_token}
+    broadcaster_id = get_cache().get("user", channel_id.lower())
+    if broadcaster_id is None:
+        user = (await client.get("https://api.twitch.tv/helix/users", params={"login": channel_id}, headers=headers)).json()
+        if not user.get("data"):
+            raise ConsoleError("Channel {} not found".format(channel_id))
+
+        broadcaster_id = user["data"][0]["id"]
+        get_cache().put("user", channel_id.lower(), broadcaster_id)
+
+    slots = asyncio.Semaphore(workers)
+    clips = {}
+
+    async def get_page(start, end, cursor=None):
+        params = {"broadcaster_id": broadcaster_id, "first": limit, "started_at": _helix_time(start), "ended_at": _helix_time(end)}
+        if cursor:
+            params["after"] = cursor
+
+        async def attempt(url):
+            async with slots:
+                response = await client.get(url, params=params, headers=headers)
+            response.raise_for_status()
+            return response.json()
+
+        # A 429 pauses every window until the rate limit resets, instead of failing the listing
+        page = await retry_async("https://api.twitch.tv/helix/clips", attempt)
+        for clip in page["data"]:
+            clips[clip["id"]] = clip
+        return page
+
+    async def get_window(start, end):
+        page = await get_page(start, end)
+        if len(page["data"]) < limit:
+            return
+
+        if end - start > MIN_CLIP_WINDOW:
+            middle = start + (end - start) / 2
+            await gather_or_cancel(get_window(start, middle), get_window(middle, end))
+            return
+
+        cursor = page.get("pagination", {}).get("cursor")
+        while cursor:
+            page = await get_page(start, end, cursor)
+            cursor = page.get("pagination", {}).get("cursor")
+
+    start = datetime.datetime(after.year(), after.month(), after.day())
+    end = datetime.datetime(before.year(), before.month(), before.day(), 23, 59, 59)
+    step = (end - start) / workers
+    await gather_or_cancel(*(get_window(start + step * i, start + step * (i + 1)) for i in range(workers)))
+
+    return sorted(clips.values(), key=lambda clip: clip["view_count"], reverse=True)
+
+
 def get_clips_filtered(channel_id, after, before, client_id, access_token, limit=100):
-    user = requests.get("https://api.twitch.tv/helix/users?login=" + channel_id, headers={"Client-ID": client_id, "authorization": "Bearer " + access_token}).json()
-
-    # iter over all days
-
-    d0 = date(after.year(), after.month(), after.day())
-    d1 = date(before.year(), before.month(), before.day())
-    clips = []
-
-    def getter(cursor=None):
-        return requests.get(
-            "https://api.twitch.tv/helix/clips?broadcaster_id="
-            + user["data"][0]["id"]
-            + "&first="
-            + str(limit)
-            + "&started_at="
-            + str(d0)
-            + "T00:00:00Z"
-            + "&ended_at="
-            + str(d1)
-            + "T23:59:59Z"
-            + str("&after=" + cursor if cursor else ""),
-            headers={"Client-ID": client_id, "Authorization": "Bearer " + access_token},
-        ).json()
-
-    c = getter()
-
-    for x in c["data"]:
-        clips.append(x)
-
-    # if pagination is needed, recursively call the next pages
-    if "pagination" in c:
-        while c["pagination"]:
-            print("pagination   " + str(c["pagination"]["cursor"]))
-            c = getter(c["pagination"]["cursor"])
-
-            for x in c["data"]:
-                clips.append(x)
-    return clips
+    return background.run(get_clips_filtered_async(channel_id, after, before, client_id, access_token, limit))
 
 
 class GQLError(Exception):
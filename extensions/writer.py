@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+
+from typing import Any, BinaryIO, Callable, Optional, Tuple
+
+from extensions.buffers import BufferPool
+
+logger = logging.getLogger(__name__)
+
+MAX_PENDING_WRITES = 64
+"""How many chunks may wait for the disk before download tasks have to wait."""
+
+Operation = Tuple[Callable, Tuple[Any, ...], Optional[asyncio.Future]]
+
+
+class FileWriter:
+    """
+    Perform file operations for the download tasks on a dedicated thread,
+    so a slow disk doesn't block reading from the network on the event loop.
+    Operations are performed in the order they are queued.
+    """
+
+    def __init__(self, max_pending: int = MAX_PENDING_WRITES):
+        self._loop = asyncio.get_running_loop()
+        self.buffers = BufferPool()
+        """Buffers for chunks queued to be written, see `AsyncFile.write_buffer`."""
+        self._slots = asyncio.Semaphore(max_pending)
+        self._queue: "queue.Queue[Optional[Operation]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="file-writer", daemon=True)
+        self._thread.start()
+
+    def open(self, path: str, mode: str) -> "AsyncFile":
+        return AsyncFile(self, path, mode)
+
+    def schedule(self, fn: Callable, *args) -> asyncio.Future:
+        """Queue `fn` on the writer thread, returns a future for its result."""
+        future = self._loop.create_future()
+        self._queue.put((fn, args, future))
+        return future
+
+    async def submit(self, fn: Callable, *args):
+        """Queue `fn` on the writer thread, waiting only when too many operations are pending."""
+        await self._slots.acquire()
+        self._queue.put((fn, args, None))
+
+    async def aclose(self):
+        """Wait for all pending operations and stop the thread."""
+        self._queue.put(None)
+        await asyncio.to_thread(self._thread.join)
+
+    def _run(self):
+        while True:
+            operation = self._queue.get()
+            if operation is None:
+                return
+
+            fn, args, future = operation
+            try:
+                result = fn(*args)
+            except Exception as e:
+                if future is None:
+                    logger.exception("Queued file operation failed")
+                else:
+                    self._loop.call_soon_threadsafe(_set_exception, future, e)
+            else:
+                if future is not None:
+                    self._loop.call_soon_threadsafe(_set_result, future, result)
+            finally:
+                if future is None:
+                    self._loop.call_soon_threadsafe(self._slots.release)
+
+
+def _set_result(future: asyncio.Future, result: Any):
+    if not future.cancelled():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exception: Exception):
+    if not future.cancelled():
+        future.set_exception(exception)
+
+
+class AsyncFile:
+    """
+    A file whose operations are queued on a `FileWriter`. Errors are kept
+    and raised on the next write, or by the future returned from `commit`.
+    """
+
+    def __init__(self, writer: FileWriter, path: str, mode: str):
+        self.writer = writer
+        self.path = path
+        self.mode = mode
+        self.error: Optional[Exception] = None
+        self._file: Optional[BinaryIO] = None
+
+    async def __aenter__(self):
+        await self.writer.submit(self._open)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.writer.submit(self._close)
+        else:
+            # Make sure the partial file is complete on disk before it is resumed
+            await self.writer.schedule(self._close)
+
+    async def write(self, data: bytes):
+        if self.error:
+            raise self.error
+        await self.writer.submit(self._write, data)
+
+    async def write_buffer(self, buffer: bytearray, length: int):
+        """
+        Like `write` for the first `length` bytes of a buffer of the writer's
+        pool, which is released once written. The buffer must not be used
+        after this.
+        """
+        if self.error:
+            self.writer.buffers.release(buffer)
+            raise self.error
+        await self.writer.submit(self._write_buffer, buffer, length)
+
+    def commit(self, target: str) -> asyncio.Future:
+        """Rename the file to `target` once everything queued for it is written."""
+        return self.writer.schedule(self._commit, target)
+
+    def _open(self):
+        try:
+            self._file = open(self.path, self.mode)
+        except Exception as e:
+            self.error = e
+
+    def _write(self, data: bytes):
+        if self.error:
+            return
+        try:
+            self._file.write(data)
+        except Exception as e:
+            self.error = e
+
+    def _write_buffer(self, buffer: bytearray, length: int):
+        try:
+            with memoryview(buffer)[:length] as data:
+                self._write(data)
+        finally:
+            self.writer.buffers.release(buffer)
+
+    def _close(self):
+        if not self._file:
+            return
+        try:
+            self._file.close()
+        except Exception as e:
+            self.error = self.error or e
+
+    def _commit(self, target: str):
+        if self.error:
+            raise self.error
+        # Replace, a hedged request may have written the same segment
+        os.replace(self.path, target)
@@ -16,11 +16,9 @@
 
 import sys
 import os
-import httpx
-import m3u8
 import re
 import asyncio
-from typing import List, Optional, OrderedDict
+from typing import List, Optional
 import threading
 import webbrowser
 import time
@@ -45,6 +43,16 @@ from http.server import BaseHTTPRequestHandler, HTTPServer
 
 import extensions.twitch as twitch
 import extensions.http as thttp
+import extensions.journal as tjournal
+from extensions import loop as background
+from extensions.cache import stats as cache_stats
+from extensions.clients import get_client, stats as connection_stats
+from extensions.integrity import is_ts, verify_files
+from extensions.jobs import run_job
+from extensions.origins import Origins
+from extensions.playlist import parse_media_playlist
+from extensions.scheduler import Watermark
+from extensions.progess import JsonLinesSink
 
 CLIENT_ID = "um6i0x3u4m9j42plwlh0zck9kk0wzq"
 
@@ -53,6 +61,31 @@ twitch_token = None
 
 port = 4974
 
+# how many queued videos download at the same time
+MAX_PARALLEL_JOBS = 3
+
+# scheduler priority of clip downloads, videos have 0
+CLIP_PRIORITY = 1
+
+# how often damaged segments are downloaded again before giving up
+VERIFY_ROUNDS = 3
+
+
+def job_dir_name(vid, start_sec, end_sec, job_id=None):
+    # jobs run at the same time, each one gets its own temp dir, also
+    # when the same video is queued twice with different ranges
+    if job_id is not None:
+        return f"job_{job_id}"
+    return f"{vid['id']}_{start_sec}_{end_sec}"
+
+
+class ProgressSignals(QObject):
+    # emitted from worker threads, delivered to the widgets on the GUI thread
+    progress = Signal(str)
+    clip_progress = Signal(str)
+    # videos of a channel, with the fetch they are from
+    video = Signal(int, object)
+
 
 class MainWindow(QMainWindow):
     class Server(BaseHTTPRequestHandler):
@@ -103,11 +136,21 @@ class MainWindow(QMainWindow):
         widgets = self.ui
         self.videolist = []
         self.download_queue = queue.Queue()
+        self.job_slots = threading.Semaphore(MAX_PARALLEL_JOBS)
+        # progress of each running job by its temp dir, shown a line each
+        self.job_progress = {}
+        self.job_progress_lock = threading.Lock()
         self.thumbnail_queue = queue.Queue()
 
         self.settings = QSettings("settings.ini", QSettings.IniFormat)
         self.folder = self.settings.value("folder", os.getcwd())
 
+        self.signals = ProgressSignals()
+        self.signals.progress.connect(widgets.labelprogress.setText)
+        self.signals.clip_progress.connect(widgets.labelprogress_2.setText)
+        self.signals.video.connect(self.add_video_row)
+        self.video_fetch = 0
+
         print(f"output folder: {self.folder}")
 
         # USE CUSTOM TITLE BAR | USE AS "False" FOR MAC OR LINUX
@@ -224,6 +267,25 @@ class MainWindow(QMainWindow):
         threading.Thread(target=self.download_queue_worker, daemon=True).start()
         threading.Thread(target=self.thumbnail_queue_worker, daemon=True).start()
 
+        # pick up the jobs which didn't finish last time
+        unfinished = tjournal.get_journal().unfinished()
+        for job in unfinished:
+            print(f"Resuming download of video {job.video['id']} (job {job.id})")
+            self.download_queue.put((job.start_sec, job.end_sec, job.video, job.id))
+        if unfinished:
+            # fetch the access tokens of all of them in one batched request
+            threading.Thread(
+                target=self.prefetch_access_tokens,
+                args=([job.video["id"] for job in unfinished],),
+                daemon=True,
+            ).start()
+
+    def prefetch_access_tokens(self, video_ids):
+        try:
+            twitch.get_access_tokens(list(dict.fromkeys(video_ids)), twitch_token)
+        except Exception as e:
+            print(f"Failed to fetch access tokens: {e}")
+
     def format_video_length(self, length_seconds):
         h = str(length_seconds // 3600).zfill(2)
         m = str((length_seconds - int(h) * 3600) // 60).zfill(2)
@@ -298,33 +360,51 @@ class MainWindow(QMainWindow):
         print(f"loaded thumbnail {i}")
 
     def fetch_videos(self):
-        # demo fill table
         self.videolist = []
         channel = widgets.lineEdit_2.text()
-        vids = twitch.get_channel_videos(channel, limit=100, sort="time")["edges"]
         widgets.tableWidget_4.clearContents()
-        widgets.tableWidget_4.setRowCount(len(vids))
+        widgets.tableWidget_4.setRowCount(0)
         self.thumbnail_queue = queue.Queue()
-        for i in range(len(vids)):
-            vid = vids[i]["node"]
-            self.videolist.append(vid)
 
-            hms_format = self.format_video_length(int(vid["lengthSeconds"]))
+        # rows are added as pages arrive, a newer fetch makes older ones stop
+        self.video_fetch += 1
+        background.submit(self.fetch_videos_async(channel, self.video_fetch))
 
-            # https://static-cdn.jtvnw.net/cf_vods/dgeft87wbj63p/f305f4af8112e23ea4fe_kdrkitten_40102156741_1698483075//thumb/thumb0-{width}x{height}.jpg
+    async def fetch_videos_async(self, channel, fetch):
+        try:
+            async for vid in twitch.iter_channel_videos(channel, sort="time"):
+                if fetch != self.video_fetch:
+                    break
+                self.signals.video.emit(fetch, vid)
+        except Exception as e:
+            print(e)
+
+    def add_video_row(self, fetch, vid):
+        # emitted before a newer fetch started, but delivered after the
+        # table was reset for it
+        if fetch != self.video_fetch:
+            return
 
-            widgets.tableWidget_4.setCellWidget(i, 0, QLabel())
-            widgets.tableWidget_4.setItem(
-                i,
-                1,
-                QTableWidgetItem(
-                    f"{vid['createdAt']}\n{hms_format}\n{vid['viewCount']}"
-                ),
-            )
-            widgets.tableWidget_4.setItem(i, 2, QTableWidgetItem(vid["title"]))
-            widgets.tableWidget_4.setRowHeight(i, 120)
-            widgets.tableWidget_4.setColumnWidth(0, 213)  #
-            self.thumbnail_queue.put(i)
+        i = len(self.videolist)
+        self.videolist.append(vid)
+        widgets.tableWidget_4.setRowCount(i + 1)
+
+        hms_format = self.format_video_length(int(vid["lengthSeconds"]))
+
+        # https://static-cdn.jtvnw.net/cf_vods/dgeft87wbj63p/f305f4af8112e23ea4fe_kdrkitten_40102156741_1698483075//thumb/thumb0-{width}x{height}.jpg
+
+        widgets.tableWidget_4.setCellWidget(i, 0, QLabel())
+        widgets.tableWidget_4.setItem(
+            i,
+            1,
+            QTableWidgetItem(
+                f"{vid['createdAt']}\n{hms_format}\n{vid['viewCount']}"
+            ),
+        )
+        widgets.tableWidget_4.setItem(i, 2, QTableWidgetItem(vid["title"]))
+        widgets.tableWidget_4.setRowHeight(i, 120)
+        widgets.tableWidget_4.setColumnWidth(0, 213)  #
+        self.thumbnail_queue.put(i)
 
     def get_pixmap_from_url(self, url):
         response = requests.get(url)
@@ -361,16 +441,46 @@ class MainWindow(QMainWindow):
                 time.sleep(1)
 
     def download_queue_worker(self):
+        # several videos download at once, sharing the workers of the scheduler
         while True:
-            if not self.download_queue.empty():
-                # get first item
-                start_sec, end_sec, vid = self.download_queue.get()
-                self.populate_table_row(vid)
-                self.donwload_video(start_sec, end_sec, vid)
-                # print(f"fake   download video {vid['id']} from {start_sec} to {end_sec}")
-                self.download_queue.task_done()
-            else:
-                time.sleep(1)
+            start_sec, end_sec, vid, job_id = self.download_queue.get()
+            self.job_slots.acquire()
+            threading.Thread(
+                target=self.download_queue_job,
+                args=(start_sec, end_sec, vid, job_id),
+                daemon=True,
+            ).start()
+
+    def download_queue_job(self, start_sec, end_sec, vid, job_id):
+        journal = tjournal.get_journal()
+        journal.set_state(job_id, tjournal.DOWNLOADING)
+        try:
+            self.populate_table_row(vid)
+            self.donwload_video(start_sec, end_sec, vid, job_id)
+            journal.set_state(job_id, tjournal.DONE)
+        except Exception as e:
+            journal.set_state(job_id, tjournal.FAILED)
+            print(f"Failed to download video {vid['id']}: {e}")
+            self.set_job_progress(
+                job_dir_name(vid, start_sec, end_sec, job_id),
+                f"VOD {vid['id']}: Failed",
+                done=True,
+            )
+        finally:
+            self.job_slots.release()
+            self.download_queue.task_done()
+
+    def set_job_progress(self, job, text, done=False):
+        # called from the download threads and the background loop, the
+        # label shows a line for every job which runs at the same time
+        with self.job_progress_lock:
+            self.job_progress[job] = text
+            lines = list(self.job_progress.values())
+            if done:
+                del self.job_progress[job]
+        self.signals.progress.emit(
+            "\n".join(lines) + "  -  " + str(self.download_queue.qsize()) + " in queue"
+        )
 
     def donwload_video_proxy(self):
         # import threading
@@ -394,7 +504,8 @@ class MainWindow(QMainWindow):
 
         # self.download_queue.append((start_sec, end_sec, video))
         video["thumbpix"] = widgets.tableWidget_4.cellWidget(row, 0).pixmap()
-        self.download_queue.put((start_sec, end_sec, video))
+        job_id = tjournal.get_journal().add(video, start_sec, end_sec)
+        self.download_queue.put((start_sec, end_sec, video, job_id))
         print(
             f"Added video to download queue: {video['id']} - {video['title']} from {start_sec} to {end_sec} (queue size: {self.download_queue.qsize()})"
         )
@@ -409,13 +520,13 @@ class MainWindow(QMainWindow):
         url_slug = widgets.lineEdit_5.text()
         self.download_internal_clip(url_slug, label=widgets.donwload_stat_link)
 
-    def donwload_video(self, start_sec, end_sec, vid):
+    def donwload_video(self, start_sec, end_sec, vid, job_id=None):
         # get selected video
 
         print(f"download video {vid['id']} from {start_sec} to {end_sec}")
 
         print(vid)
-        access_token = twitch.get_access_token(vid["id"], twitch_token)
+        access_token = twitch.get_cached_access_token(vid["id"], twitch_token)
         args = {
             "output": "{date}_{id}_{channel_login}_{title_slug}_{start_sec}_{end_sec}.{format}",
             "format": "mp4",
@@ -428,12 +539,13 @@ class MainWindow(QMainWindow):
         playlist_uri = twitch._get_playlist_by_name(playlists, "source")
 
         print("<dim>Fetching playlist...</dim>")
-        response = httpx.get(playlist_uri)
+        response = get_client().get(playlist_uri)
         response.raise_for_status()
-        playlist = m3u8.loads(response.text)
+        playlist = parse_media_playlist(response.text)
 
         base_uri = re.sub("/[^/]+$", "/", playlist_uri)
-        target_dir = twitch._crete_temp_dir(base_uri, self.folder)
+        job = job_dir_name(vid, start_sec, end_sec, job_id)
+        target_dir = twitch._crete_temp_dir(base_uri, self.folder, job)
         t = twitch._get_vod_paths(playlist, start_sec, end_sec)
         print(start_sec, end_sec)
         # print(t)
@@ -446,46 +558,75 @@ class MainWindow(QMainWindow):
             f.write(response.text)
 
         def set_progresstxt(text):
-            widgets.labelprogress.setText(
-                text + "  -  " + str(self.download_queue.qsize()) + " in queue"
-            )
+            self.set_job_progress(job, f"VOD {vid['id']}: {text}")
 
-        print(
-            "\nDownloading {} VODs using {} workers to {}".format(
-                len(vod_paths), 20, target_dir
+        # optional machine readable progress, one JSON object per line
+        progress_log = self.settings.value("progress_log", "")
+        subscribers = [JsonLinesSink(progress_log)] if progress_log else []
+
+        sources = [base_uri + path for path in vod_paths]
+
+        def refresh_sources():
+            # the token expired during a long download, the segments are the
+            # same but may be served from a new playlist location
+            print("<dim>Access token expired, fetching playlists again...</dim>")
+            token = twitch.get_cached_access_token(vid["id"], twitch_token, refresh=True)
+            playlists = twitch._parse_playlists(
+                twitch.get_playlists(vid["id"], token, refresh=True)
             )
+            uri = twitch._get_playlist_by_name(list(playlists), "source")
+            return [re.sub("/[^/]+$", "/", uri) + path for path in vod_paths]
+
+        def resolve_origins():
+            # the same segments are usually on other edges as well, a fresh
+            # master playlist may point to a different one
+            token = twitch.get_cached_access_token(vid["id"], twitch_token)
+            playlists = list(twitch._parse_playlists(
+                twitch.get_playlists(vid["id"], token, refresh=True)
+            ))
+            uri = twitch._get_playlist_by_name(playlists, "source")
+            return twitch._get_playlist_bases(playlists, uri)
+
+        origins = Origins(
+            twitch._get_playlist_bases(playlists, playlist_uri),
+            resolve=lambda: asyncio.to_thread(resolve_origins),
         )
-        sources = [base_uri + path for path in vod_paths]
         targets = [
             os.path.join(target_dir, "{:05d}.ts".format(k))
             for k, _ in enumerate(vod_paths)
         ]
-        # run in background
-        asyncio.run(
-            thttp.download_all(set_progresstxt, sources, targets, 20, rate_limit=None)
-        )
-
-        # Make a modified playlist which references downloaded VODs
-        # Keep only the downloaded segments and skip the rest
-        org_segments = playlist.segments.copy()
-
-        path_map = OrderedDict(zip(vod_paths, targets))
-        playlist.segments.clear()
-        for segment in org_segments:
-            if segment.uri in path_map:
-                segment.uri = path_map[segment.uri]
-                playlist.segments.append(segment)
-
-        playlist_path = os.path.join(target_dir, "playlist_downloaded.m3u8")
-        playlist.dump(playlist_path)
 
-        print("\n\nJoining files...")
-        set_progresstxt("Creating Video File...")
-        print(target)
-        print(target_dir)
-        # append :00 to time for frames
-        # start = widgets.timeEdit_2.text() + ":00"
-        # end = widgets.timeEdit.text() + ":00"
+        # record every finished segment, so after a crash only the missing
+        # and untrusted ones are downloaded again
+        if job_id is not None:
+            journal = tjournal.get_journal()
+            journal.set_segments(job_id, vod_paths, targets)
+            kept = journal.verify(job_id)
+            if kept:
+                print(f"Resuming job {job_id}, {kept}/{len(targets)} segments already downloaded")
+
+        def download_segments():
+            watermark = Watermark(len(targets))
+            if job_id is not None:
+                watermark.subscribe_segments(
+                    lambda index: journal.segment_done(job_id, index, targets[index])
+                )
+            background.run(
+                run_job(
+                    f"VOD {vid['id']}",
+                    lambda job: thttp.download_all(
+                        set_progresstxt,
+                        sources,
+                        targets,
+                        rate_limit=None,
+                        refresh=lambda: asyncio.to_thread(refresh_sources),
+                        subscribers=subscribers,
+                        watermark=watermark,
+                        job=job,
+                        origins=origins,
+                    ),
+                )
+            )
 
         segment_start_sec = int(t[1])
         segment_end_sec = int(t[2])
@@ -506,13 +647,71 @@ class MainWindow(QMainWindow):
 
         print(f"start: {start} end: {end} (of direct segments)")
 
-        twitch._join_vods(
-            playlist_path, os.path.join(self.folder, target), True, vid, start
-        )
-        # delete temp folder - target_dir two levels up
-        shutil.rmtree(os.path.dirname(os.path.dirname(target_dir)))
-        set_progresstxt("Done")
+        # streaming only works for plain MPEG-TS segments which can be concatenated
+        stream = self.settings.value("stream_to_ffmpeg", False, type=bool)
+        if stream and not playlist.segment_map and all(
+            path.endswith(".ts") for path in vod_paths
+        ):
+            print(
+                "\nStreaming {} VODs using adaptive workers into ffmpeg".format(
+                    len(vod_paths)
+                )
+            )
+            twitch._stream_vods(
+                set_progresstxt,
+                sources,
+                target_dir,
+                os.path.join(self.folder, target),
+                True,
+                vid,
+                start,
+                subscribers,
+            )
+        else:
+            print(
+                "\nDownloading {} VODs using adaptive workers to {}".format(
+                    len(vod_paths), target_dir
+                )
+            )
+            download_segments()
+
+            # check all segments again before joining, segments which were
+            # already on disk were never checked and files can be damaged
+            set_progresstxt("Verifying segments...")
+            # targets are named .ts either way, the MPEG-TS checks only
+            # apply when the playlist's segments are
+            ts = all(is_ts(path) for path in vod_paths)
+            invalid = verify_files(targets, ts=ts)
+            for _ in range(VERIFY_ROUNDS):
+                if not invalid:
+                    break
+                print(f"{len(invalid)} segments are damaged, downloading them again")
+                for index in invalid:
+                    if os.path.exists(targets[index]):
+                        os.remove(targets[index])
+                download_segments()
+                invalid = verify_files(targets, ts=ts)
+            if invalid:
+                raise twitch.ConsoleError(f"{len(invalid)} segments are still damaged")
+
+            # Make a modified playlist which references downloaded VODs
+            # Keep only the downloaded segments and skip the rest
+            playlist_path = os.path.join(target_dir, "playlist_downloaded.m3u8")
+            playlist.dump(playlist_path, t.indices, targets)
+
+            print("\n\nJoining files...")
+            set_progresstxt("Creating Video File...")
+            print(target)
+            print(target_dir)
+
+            twitch._join_vods(
+                playlist_path, os.path.join(self.folder, target), True, vid, start
+            )
+        # delete the temp folder of this job only, others may still be running
+        shutil.rmtree(twitch._temp_job_dir(self.folder, job))
+        self.set_job_progress(job, f"VOD {vid['id']}: Done", done=True)
         print("Done")
+        print(f"Connections: {connection_stats}, cache: {cache_stats}")
 
     def logout(self):
         global twitch_token
@@ -562,28 +761,83 @@ class MainWindow(QMainWindow):
                     json.loads(widgets.tableWidget_5.item(i.row(), 5).text())
                 )
 
-        for i in range(len(to_download)):
-            widgets.labelprogress_2.setText(
-                f"Downloading clip {i+1}/{len(to_download)}"
+        # Look up all clips and their access tokens in a few batched requests
+        self.signals.clip_progress.emit(f"Fetching {len(to_download)} clips...")
+        slugs = [twitch._clip_slug(clip["url"]) for clip in to_download]
+        clips = twitch.get_clips(slugs)
+        access_tokens = twitch.get_clip_access_tokens(slugs)
+
+        sources = []
+        targets = []
+        for slug in slugs:
+            try:
+                url, target = self.resolve_clip(
+                    slug, clip=clips[slug], access_token=access_tokens[slug]
+                )
+            except Exception as e:
+                print(f"Failed to download clip {slug}: {e}")
+                continue
+            sources.append(url)
+            targets.append(target)
+
+        # optional machine readable progress, one JSON object per line
+        progress_log = self.settings.value("progress_log", "")
+        subscribers = [JsonLinesSink(progress_log)] if progress_log else []
+
+        print(f"\nDownloading {len(sources)} clips using adaptive workers")
+        failed = {}
+        # clips are small, let them go ahead of running VODs
+        background.run(
+            run_job(
+                f"{len(sources)} clips",
+                lambda job: thttp.download_all(
+                    self.signals.clip_progress.emit,
+                    sources,
+                    targets,
+                    subscribers=subscribers,
+                    failed=failed,
+                    job=job,
+                ),
+                priority=CLIP_PRIORITY,
             )
-            self.download_internal_clip(to_download[i]["url"], widgets.labelprogress_2)
+        )
+        for i, e in failed.items():
+            print(f"Failed to download clip {targets[i]}: {e}")
+        print(f"Connections: {connection_stats}, cache: {cache_stats}")
 
-    def download_internal_clip(self, clip_url, label):
+        self.signals.clip_progress.emit(
+            f"Done, {len(sources) - len(failed)}/{len(to_download)} clips downloaded"
+        )
+
+    def resolve_clip(self, clip_url, clip=None, access_token=None):
+        """Return the authenticated source URL and the target path of a clip."""
         args = {
             "output": "{date}_{id}_{channel_login}_{title_slug}.{format}",
             "format": "mp4",
         }
-        slug = clip_url.replace("https://clips.twitch.tv/", "")
+        slug = twitch._clip_slug(clip_url)
+
+        for result in (clip, access_token):
+            if isinstance(result, Exception):
+                raise result
 
-        clip = twitch.get_clip(slug)
+        if clip is None:
+            clip = twitch.get_clip(slug)
+        if not clip:
+            raise twitch.ConsoleError("Clip '{}' not found".format(slug))
 
         target = twitch._clip_target_filename(clip, args)
         target = os.path.join(self.folder, target)
         print("Target: <blue>{}</blue>".format(target))
 
-        url = twitch.get_clip_authenticated_url(slug, "source")
+        url = twitch.get_clip_authenticated_url(slug, "source", access_token)
         print("<dim>Selected URL: {}</dim>".format(url))
 
+        return url, target
+
+    def download_internal_clip(self, clip_url, label):
+        url, target = self.resolve_clip(clip_url)
+
         print("<dim>Downloading clip...</dim>")
         twitch.download_file(url, target)
 
@@ -633,6 +887,7 @@ class MainWindow(QMainWindow):
             access_token=twitch_token,
             client_id=CLIENT_ID,
         )
+        print(f"Connections: {connection_stats}, cache: {cache_stats}")
 
         widgets.tableWidget_5.clearContents()
         widgets.tableWidget_5.setRowCount(len(clips))
@@ -0,0 +1,75 @@
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Tuple
+
+import pytest
+
+from extensions import retries
+
+Response = Tuple[int, dict, bytes]
+
+
+class FaultyServer:
+    """
+    A local HTTP server which answers every GET with `handler(path)`, a
+    tuple of status, headers and body. Tests change the handler to inject
+    faults, and look at `requests` to see what reached the server.
+    """
+
+    def __init__(self):
+        self.handler: Callable[[str], Response] = lambda path: (200, {}, b"ok")
+        self.requests: List[str] = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append(self.path)
+                status, headers, body = server.handler(self.path)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self._server.server_port}/"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def url(self, path: str) -> str:
+        return self.base + path
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def make_server():
+    """Start any number of `FaultyServer`s, each is a different host to the circuit breakers."""
+    servers = []
+
+    def make() -> FaultyServer:
+        servers.append(FaultyServer())
+        return servers[-1]
+
+    yield make
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def server(make_server) -> FaultyServer:
+    return make_server()
+
+
+@pytest.fixture(autouse=True)
+def breakers():
+    """Every test starts with closed circuits."""
+    retries._breakers.clear()
+    yield retries._breakers
+    retries._breakers.clear()
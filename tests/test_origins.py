@@ -0,0 +1,95 @@
+import asyncio
+import os
+import time
+
+from extensions import http
+from extensions.origins import Origins
+from extensions.retries import CircuitBreaker
+
+SEGMENT = b"x" * 1000
+
+
+def download(origins: Origins, count: int, tmp_path) -> list:
+    sources = [origins.origins[0].base + f"{index}.bin" for index in range(count)]
+    targets = [str(tmp_path / f"{index}.bin") for index in range(count)]
+    asyncio.run(http.download_all(lambda text: None, sources, targets, workers=4, origins=origins))
+    return targets
+
+
+def serving(status: int = 200, until: float = 0.0):
+    """A handler which answers `status` until `until`, and the segment after that."""
+    def handler(path):
+        if status != 200 and (not until or time.monotonic() < until):
+            return status, {}, b""
+        return 200, {}, SEGMENT
+    return handler
+
+
+def host(server) -> str:
+    return server.base.split("/")[2]
+
+
+def test_moves_to_another_origin_when_degraded(make_server, tmp_path):
+    primary, alternate = make_server(), make_server()
+    primary.handler = serving(503)
+    alternate.handler = serving()
+    origins = Origins([primary.base, alternate.base])
+
+    targets = download(origins, 20, tmp_path)
+
+    assert all(os.path.getsize(target) == len(SEGMENT) for target in targets)
+    assert origins.current is origins.origins[1]
+    assert origins.origins[0].degraded
+    assert len(alternate.requests) == 20
+
+
+def test_drops_an_origin_without_the_segments(make_server, breakers, tmp_path):
+    primary, alternate = make_server(), make_server()
+    breakers[host(primary)] = CircuitBreaker(host(primary), cooldown=0.3)
+    primary.handler = serving(503, until=time.monotonic() + 0.5)
+    alternate.handler = serving(404)
+    origins = Origins([primary.base, alternate.base])
+
+    targets = download(origins, 20, tmp_path)
+
+    assert all(os.path.getsize(target) == len(SEGMENT) for target in targets)
+    assert origins.origins[1].missing
+    assert origins.current is origins.origins[0]
+    # Requests in flight when the first 404 came back, none after
+    assert len(alternate.requests) <= 4
+
+
+def test_moves_to_a_much_faster_origin():
+    origins = Origins(["http://slow/", "http://fast/"])
+    for _ in range(5):
+        origins.record("http://slow/0.ts", 1_000_000, 1.0)
+    origins.record("http://fast/0.ts", 1_000_000, 0.1)
+
+    assert origins.url("http://slow/1.ts") == "http://fast/1.ts"
+    # Sources of any origin go to the current one
+    assert origins.url("http://slow/2.ts") == origins.url("http://fast/2.ts") == "http://fast/2.ts"
+
+
+def test_stays_on_a_slightly_slower_origin():
+    origins = Origins(["http://a/", "http://b/"])
+    for _ in range(5):
+        origins.record("http://a/0.ts", 1_000_000, 1.0)
+    origins.record("http://b/0.ts", 1_000_000, 0.8)
+
+    assert origins.url("http://a/1.ts") == "http://a/1.ts"
+
+
+def test_resolves_more_origins_when_all_are_degraded():
+    async def main():
+        async def resolve():
+            return ["http://b/"]
+
+        origins = Origins(["http://a/"], resolve)
+        for _ in range(5):
+            origins.record("http://a/0.ts", 0, 1.0, error=True)
+
+        assert origins.url("http://a/1.ts") == "http://a/1.ts"
+        await origins._resolving
+        assert origins.url("http://a/1.ts") == "http://b/1.ts"
+
+    asyncio.run(main())
@@ -0,0 +1,131 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from extensions import retries
+from extensions.concurrency import FixedConcurrency
+from extensions.retries import CircuitBreaker, RetryPolicy, retry_after, retry_async
+from extensions.scheduler import run_in_order
+
+FAST = RetryPolicy(base=0.01)
+
+
+async def fetch(client: httpx.AsyncClient, url: str) -> str:
+    response = await client.get(url)
+    response.raise_for_status()
+    return response.text
+
+
+def get(url: str, policy: RetryPolicy = FAST, tasks: int = 1) -> list:
+    async def main():
+        async with httpx.AsyncClient() as client:
+            return await asyncio.gather(*(retry_async(url, lambda url: fetch(client, url), policy=policy) for _ in range(tasks)))
+    return asyncio.run(main())
+
+
+def failing(count: int, status: int = 503, headers: dict = {}):
+    """A handler which fails the first `count` requests."""
+    requests = []
+
+    def handler(path):
+        requests.append(path)
+        return (status, headers, b"") if len(requests) <= count else (200, {}, b"ok")
+
+    return handler
+
+
+def outage(seconds: float, status: int = 503):
+    """A handler which fails every request for the first `seconds`."""
+    end = time.monotonic() + seconds
+    return lambda path: (status, {}, b"") if time.monotonic() < end else (200, {}, b"ok")
+
+
+def test_retries_server_errors(server):
+    server.handler = failing(2)
+    assert get(server.url("a.ts")) == ["ok"]
+    assert len(server.requests) == 3
+
+
+def test_final_errors_are_not_retried(server, breakers):
+    server.handler = failing(1, status=404)
+    with pytest.raises(httpx.HTTPStatusError):
+        get(server.url("a.ts"))
+    assert len(server.requests) == 1
+    # The host answered, it's not failing
+    assert breakers[server.base.split("/")[2]].failures == 0
+
+
+def test_gives_up_after_attempts(server):
+    server.handler = failing(10, status=500)
+    with pytest.raises(httpx.HTTPStatusError):
+        get(server.url("a.ts"), RetryPolicy(attempts=3, base=0.01))
+    assert len(server.requests) == 3
+
+
+def test_honors_retry_after(server):
+    server.handler = failing(1, status=429, headers={"Retry-After": "1"})
+    started = time.monotonic()
+    assert get(server.url("a.ts")) == ["ok"]
+    assert time.monotonic() - started >= 1
+
+
+def test_retry_after_headers():
+    def response(status, **headers):
+        return httpx.Response(status, headers={name.replace("_", "-"): value for name, value in headers.items()})
+
+    assert retry_after(response(503, retry_after="3")) == 3
+    assert retry_after(response(503, retry_after="1000")) == retries.MAX_RETRY_AFTER
+    assert retry_after(response(503, retry_after="Thu, 01 Jan 1970 00:00:00 GMT")) == 0
+    assert retry_after(response(503, retry_after="soon")) is None
+    assert 4 < retry_after(response(429, ratelimit_reset=str(int(time.time()) + 5))) <= 5
+    assert retry_after(response(503)) is None
+    assert retry_after(None) is None
+
+
+def test_breaker_sheds_load_during_outage(server, breakers):
+    host = server.base.split("/")[2]
+    breaker = breakers[host] = CircuitBreaker(host, threshold=3, cooldown=0.5)
+    server.handler = outage(0.4)
+
+    assert get(server.url("a.ts"), RetryPolicy(attempts=10, base=0.01), tasks=5) == ["ok"] * 5
+    assert breaker.opened == 1
+    assert not breaker.is_open
+    # The first request of every task, then a single probe which succeeds
+    assert len(server.requests) == 5 + 1 + 4
+
+
+def test_breaker_reopens_when_probe_fails(server, breakers):
+    host = server.base.split("/")[2]
+    breaker = breakers[host] = CircuitBreaker(host, threshold=3, cooldown=0.3)
+    server.handler = outage(0.5)
+
+    assert get(server.url("a.ts"), RetryPolicy(attempts=10, base=0.01), tasks=3) == ["ok"] * 3
+    assert breaker.opened == 2
+
+
+def test_slot_is_given_up_while_waiting(make_server):
+    """A download backing off doesn't keep other downloads on the same workers waiting."""
+    failing_host, healthy_host = make_server(), make_server()
+    failing_host.handler = failing(1, headers={"Retry-After": "1"})
+    finished = {}
+
+    async def download(name: str, server, count: int, concurrency):
+        async with httpx.AsyncClient() as client:
+            async def get_segment(index: int):
+                await retry_async(server.url(f"{index}.ts"), lambda url: fetch(client, url), policy=FAST)
+
+            await run_in_order(count, concurrency, get_segment)
+        finished[name] = time.monotonic()
+
+    async def main():
+        shared = FixedConcurrency(1)
+        failing_job = asyncio.ensure_future(download("failing", failing_host, 1, shared))
+        while not failing_host.requests:
+            await asyncio.sleep(0.01)
+        await asyncio.gather(failing_job, download("healthy", healthy_host, 3, shared))
+
+    asyncio.run(main())
+    assert finished["healthy"] < finished["failing"]
+    assert len(healthy_host.requests) == 3